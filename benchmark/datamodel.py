@@ -0,0 +1,79 @@
+'''Benchmark datamodel (molgenis.csv) construction: row-by-row DataFrame.append versus list-of-records assembly
+
+Run from the repository root: python -m benchmark.datamodel --instruments 50 --fields 100'''
+import argparse
+import pathlib
+import re
+import tempfile
+import time
+import pandas as pd
+
+import benchmark.generate
+import src.cdisc
+import src.emx2
+import src.REDCap.datamodel
+import src.REDCap.utils
+
+
+def append_datamodel(xml: src.cdisc.Cdisc, ns: str, subject_data_name: str) -> pd.DataFrame:
+    '''previous implementation, grow the datamodel one DataFrame.append per row'''
+    result = src.REDCap.utils.datamodel_table_columns()
+    for instrument in src.REDCap.utils.defined_instruments(xml, ns):
+        result = result.append({'tableName': instrument}, ignore_index=True)
+        result = result.append({
+            'tableName': instrument,
+            'columnName': 'key',
+            'columnType': 'ref',
+            'refTable': subject_data_name,
+            'key': '1',
+            'required': 'TRUE'}, ignore_index=True)
+        result = result.append({
+            'tableName': instrument,
+            'columnName': 'SubjectKey',
+            'required': 'TRUE'}, ignore_index=True)
+        result = result.append({
+            'tableName': instrument,
+            'columnName': 'FormRepeatKey'}, ignore_index=True)
+
+    for tablename, item_refs in xml.index.item_group_defs.items():
+        for c in [item['ItemOID'] for item in item_refs]:
+            result = result.append({
+                'tableName': tablename.split('.')[0],
+                'columnName': re.sub('___\d+$', '', c),
+                'description': xml.index.item_def(c, ns + 'FieldNote'),
+                'DataType': xml.index.item_def(c, 'DataType'),
+                'FieldType': xml.index.item_def(c, ns + 'FieldType'),
+                'TextValidationType': xml.index.item_def(c, ns + 'TextValidationType')
+            }, ignore_index=True)
+    return src.emx2.Emx2.REDCap_datatype(result)
+
+def main(instruments: int, fields: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        file = pathlib.Path(tmp).joinpath('benchmark.xml')
+        benchmark.generate.generate(file, subjects=1, instruments=instruments, fields=fields)
+        xml = src.cdisc.Cdisc(str(file), 'REDCap')
+        xml.index
+
+    datamodel = src.REDCap.datamodel.REDCapDatamodel(xml)
+    print(f'{instruments} instruments, {fields} fields ({instruments * fields} variables)')
+
+    start = time.perf_counter()
+    appended = append_datamodel(xml, datamodel.ns, datamodel.subject_data_name)
+    append = time.perf_counter() - start
+
+    start = time.perf_counter()
+    records = datamodel.generate_instruments(to_csv=False, to_dataframe=True)
+    batched = time.perf_counter() - start
+
+    identical = appended.fillna('').equals(records.fillna(''))
+    print(f'DataFrame.append: {append:.2f}s')
+    print(f'records:          {batched:.2f}s ({append / batched:.0f}x)')
+    print(f'identical datamodel: {identical}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--instruments', type=int, default=50)
+    parser.add_argument('--fields', type=int, default=100)
+    args = parser.parse_args()
+    main(args.instruments, args.fields)
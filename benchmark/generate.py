@@ -0,0 +1,182 @@
+'''Generate a (large) synthetic REDCap CDISC ODM export
+
+Besides plain fields every instrument can have checkbox fields (one boolean item per choice, field___1 ..)
+and radio/select fields with a CodeList. The last instruments can be repeating instruments, ClinicalData is
+then written per StudyEventData with 1 up to repeats FormData per subject.'''
+import argparse
+import random
+from xml.sax.saxutils import quoteattr
+
+ODM = ('<ODM xmlns="http://www.cdisc.org/ns/odm/v1.3" xmlns:ds="http://www.w3.org/2000/09/xmldsig#" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:redcap="https://projectredcap.org" '
+    'ODMVersion="1.3.1" FileOID="000-00-0000" FileType="Snapshot" Description="Benchmark" '
+    'SourceSystem="REDCap" SourceSystemVersion="10.0.23">\n')
+
+# (DataType, redcap:FieldType, redcap:TextValidationType)
+FIELD_TYPES = [
+    ('text', 'text', None),
+    ('integer', 'text', 'int'),
+    ('float', 'text', 'number'),
+    ('date', 'text', 'date_ymd'),
+    ('text', 'textarea', None),
+]
+
+# redcap:FieldType of the fields with a CodeList
+CODELIST_TYPES = ['radio', 'select']
+
+CHOICES = ['Apple', 'Pear', 'Windows ME', 'Warm socks', 'Tandenborstel', 'Paspoort', 'Tante Annie', 'Slippers']
+
+EVENT = 'event_1_arm_1'
+
+
+def instrument_name(i: int) -> str:
+    return f'instrument_{i}'
+
+def field_name(i: int, j: int) -> str:
+    return f'field_{i}_{j}'
+
+def checkbox_name(i: int, c: int) -> str:
+    return f'checkbox_{i}_{c}'
+
+def codelist_name(i: int, c: int) -> str:
+    return f'choice_{i}_{c}'
+
+def value(datatype: str, rng: random.Random) -> str:
+    '''random value for the given DataType'''
+    if datatype == 'integer':
+        return str(rng.randint(0, 250))
+    if datatype == 'float':
+        return f'{rng.uniform(0, 100):.2f}'
+    if datatype == 'date':
+        return f'20{rng.randint(10, 21)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+    return rng.choice(['Apple', 'Pear', 'Windows ME', 'Warm socks', 'Lorem ipsum dolor sit amet'])
+
+def choices(n: int) -> str:
+    '''redcap:CheckboxChoices, 1, Apple | 2, Pear ..'''
+    return ' | '.join(f'{k}, {CHOICES[(k - 1) % len(CHOICES)]}' for k in range(1, n + 1))
+
+def generate(file: str, subjects: int = 1000, instruments: int = 5, fields: int = 20, seed: int = 1,
+        repeating: int = 0, repeats: int = 3, checkboxes: int = 0, codelists: int = 0, options: int = 4) -> None:
+    '''write a REDCap CDISC ODM export with ClinicalData for every subject, instrument and field
+
+    repeating: number of repeating instruments (the last ones), each subject has 1 up to repeats of them
+    checkboxes: checkbox fields per instrument, codelists: radio/select fields per instrument, both with options choices'''
+    rng = random.Random(seed)
+    field_types = {
+        (i, j): FIELD_TYPES[0] if j == 0 else rng.choice(FIELD_TYPES)
+        for i in range(instruments) for j in range(fields)}
+    repeating_instruments = set(range(max(instruments - repeating, 0), instruments))
+
+    with open(file, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
+        f.write(ODM)
+        f.write('<Study OID="Project.Benchmark">\n')
+        f.write('<GlobalVariables>\n\t<StudyName>Benchmark</StudyName>\n'
+            '\t<StudyDescription>Synthetic REDCap export</StudyDescription>\n'
+            '\t<ProtocolName>Benchmark</ProtocolName>\n')
+        if repeating_instruments:
+            f.write('\t<redcap:RepeatingInstrumentsAndEvents>\n\t\t<redcap:RepeatingInstruments>\n')
+            for i in sorted(repeating_instruments):
+                f.write(f'\t\t\t<redcap:RepeatingInstrument redcap:UniqueEventName="{EVENT}" redcap:RepeatInstrument="{instrument_name(i)}" redcap:CustomLabel=""/>\n')
+            f.write('\t\t</redcap:RepeatingInstruments>\n\t</redcap:RepeatingInstrumentsAndEvents>\n')
+        f.write('</GlobalVariables>\n')
+        f.write('<MetaDataVersion OID="Metadata.Benchmark" Name="Benchmark" redcap:RecordIdField="field_0_0">\n')
+
+        if repeating_instruments:
+            f.write(f'\t<Protocol>\n\t\t<StudyEventRef StudyEventOID="Event.{EVENT}" OrderNumber="1" Mandatory="No"/>\n\t</Protocol>\n')
+            f.write(f'\t<StudyEventDef OID="Event.{EVENT}" Name="Event 1" Type="Common" Repeating="No" redcap:EventName="Event 1" '
+                f'redcap:CustomEventLabel="" redcap:UniqueEventName="{EVENT}" redcap:ArmNum="1" redcap:ArmName="Arm 1">\n')
+            for i in range(instruments):
+                f.write(f'\t\t<FormRef FormOID="Form.{instrument_name(i)}" OrderNumber="{i + 1}" Mandatory="No" redcap:FormName="{instrument_name(i)}"/>\n')
+            f.write('\t</StudyEventDef>\n')
+
+        for i in range(instruments):
+            f.write(f'\t<FormDef OID="Form.{instrument_name(i)}" Name="Instrument {i}" Repeating="No" redcap:FormName="{instrument_name(i)}">\n')
+            f.write(f'\t\t<ItemGroupRef ItemGroupOID="{instrument_name(i)}.{field_name(i, 0)}" Mandatory="No"/>\n')
+            f.write('\t</FormDef>\n')
+        for i in range(instruments):
+            f.write(f'\t<ItemGroupDef OID="{instrument_name(i)}.{field_name(i, 0)}" Name="Instrument {i}" Repeating="No">\n')
+            for j in range(fields):
+                f.write(f'\t\t<ItemRef ItemOID="{field_name(i, j)}" Mandatory="No" redcap:Variable="{field_name(i, j)}"/>\n')
+            for c in range(checkboxes):
+                for k in range(1, options + 1):
+                    f.write(f'\t\t<ItemRef ItemOID="{checkbox_name(i, c)}___{k}" Mandatory="No" redcap:Variable="{checkbox_name(i, c)}"/>\n')
+            for c in range(codelists):
+                f.write(f'\t\t<ItemRef ItemOID="{codelist_name(i, c)}" Mandatory="No" redcap:Variable="{codelist_name(i, c)}"/>\n')
+            f.write('\t</ItemGroupDef>\n')
+        for (i, j), (datatype, fieldtype, validation) in field_types.items():
+            validation = f' redcap:TextValidationType="{validation}"' if validation else ''
+            f.write(f'\t<ItemDef OID="{field_name(i, j)}" Name="{field_name(i, j)}" DataType="{datatype}" Length="999" '
+                f'redcap:Variable="{field_name(i, j)}" redcap:FieldType="{fieldtype}"{validation} redcap:FieldNote="Note {i} {j}">\n'
+                f'\t\t<Question><TranslatedText>Field {i} {j}</TranslatedText></Question>\n\t</ItemDef>\n')
+        for i in range(instruments):
+            for c in range(checkboxes):
+                for k in range(1, options + 1):
+                    f.write(f'\t<ItemDef OID="{checkbox_name(i, c)}___{k}" Name="{checkbox_name(i, c)}___{k}" DataType="boolean" Length="1" '
+                        f'redcap:Variable="{checkbox_name(i, c)}" redcap:FieldType="checkbox" redcap:FieldNote="Checkbox {i} {c}">\n'
+                        f'\t\t<Question><TranslatedText>Checkbox {i} {c}</TranslatedText></Question>\n'
+                        f'\t\t<CodeListRef CodeListOID="{checkbox_name(i, c)}___{k}.choices"/>\n\t</ItemDef>\n')
+            for c in range(codelists):
+                f.write(f'\t<ItemDef OID="{codelist_name(i, c)}" Name="{codelist_name(i, c)}" DataType="text" Length="1" '
+                    f'redcap:Variable="{codelist_name(i, c)}" redcap:FieldType="{CODELIST_TYPES[c % len(CODELIST_TYPES)]}" redcap:FieldNote="Choice {i} {c}">\n'
+                    f'\t\t<Question><TranslatedText>Choice {i} {c}</TranslatedText></Question>\n'
+                    f'\t\t<CodeListRef CodeListOID="{codelist_name(i, c)}.choices"/>\n\t</ItemDef>\n')
+        for i in range(instruments):
+            for c in range(checkboxes):
+                for k in range(1, options + 1):
+                    f.write(f'\t<CodeList OID="{checkbox_name(i, c)}___{k}.choices" Name="{checkbox_name(i, c)}___{k}" DataType="boolean" '
+                        f'redcap:Variable="{checkbox_name(i, c)}" redcap:CheckboxChoices="{choices(options)}">\n'
+                        '\t\t<CodeListItem CodedValue="1"><Decode><TranslatedText>Checked</TranslatedText></Decode></CodeListItem>\n'
+                        '\t\t<CodeListItem CodedValue="0"><Decode><TranslatedText>Unchecked</TranslatedText></Decode></CodeListItem>\n'
+                        '\t</CodeList>\n')
+            for c in range(codelists):
+                f.write(f'\t<CodeList OID="{codelist_name(i, c)}.choices" Name="{codelist_name(i, c)}" DataType="text" redcap:Variable="{codelist_name(i, c)}">\n')
+                for k in range(1, options + 1):
+                    f.write(f'\t\t<CodeListItem CodedValue="{k}"><Decode><TranslatedText>{CHOICES[(k - 1) % len(CHOICES)]}</TranslatedText></Decode></CodeListItem>\n')
+                f.write('\t</CodeList>\n')
+        f.write('</MetaDataVersion>\n</Study>\n')
+
+        def form_data(s: int, i: int, repeat: int, indent: str) -> None:
+            f.write(f'{indent}<FormData FormOID="Form.{instrument_name(i)}" FormRepeatKey="{repeat}">\n')
+            f.write(f'{indent}\t<ItemGroupData ItemGroupOID="{instrument_name(i)}.{field_name(i, 0)}" ItemGroupRepeatKey="1">\n')
+            for j in range(fields):
+                v = str(s) if j == 0 else value(field_types[(i, j)][0], rng)
+                f.write(f'{indent}\t\t<ItemData ItemOID="{field_name(i, j)}" Value={quoteattr(v)}/>\n')
+            for c in range(checkboxes):
+                for k in range(1, options + 1):
+                    f.write(f'{indent}\t\t<ItemData ItemOID="{checkbox_name(i, c)}___{k}" Value="{rng.randint(0, 1)}"/>\n')
+            for c in range(codelists):
+                f.write(f'{indent}\t\t<ItemData ItemOID="{codelist_name(i, c)}" Value="{rng.randint(1, options)}"/>\n')
+            f.write(f'{indent}\t</ItemGroupData>\n{indent}</FormData>\n')
+
+        f.write('<ClinicalData StudyOID="Project.Benchmark" MetaDataVersionOID="Metadata.Benchmark">\n')
+        for s in range(1, subjects + 1):
+            f.write(f'\t<SubjectData SubjectKey="{s}" redcap:RecordIdField="field_0_0">\n')
+            if repeating_instruments:
+                f.write(f'\t\t<StudyEventData StudyEventOID="Event.{EVENT}" StudyEventRepeatKey="1" redcap:UniqueEventName="{EVENT}">\n')
+                for i in range(instruments):
+                    for repeat in range(1, (rng.randint(1, repeats) if i in repeating_instruments else 1) + 1):
+                        form_data(s, i, repeat, '\t\t\t')
+                f.write('\t\t</StudyEventData>\n')
+            else:
+                for i in range(instruments):
+                    form_data(s, i, 1, '\t\t')
+            f.write('\t</SubjectData>\n')
+        f.write('</ClinicalData>\n</ODM>\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('file')
+    parser.add_argument('--subjects', type=int, default=1000)
+    parser.add_argument('--instruments', type=int, default=5)
+    parser.add_argument('--fields', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeating', type=int, default=0, help='number of repeating instruments')
+    parser.add_argument('--repeats', type=int, default=3, help='maximum number of repeats per subject')
+    parser.add_argument('--checkboxes', type=int, default=0, help='checkbox fields per instrument')
+    parser.add_argument('--codelists', type=int, default=0, help='radio/select fields per instrument')
+    parser.add_argument('--options', type=int, default=4, help='choices per checkbox or codelist field')
+    args = parser.parse_args()
+    generate(args.file, args.subjects, args.instruments, args.fields, args.seed,
+        args.repeating, args.repeats, args.checkboxes, args.codelists, args.options)
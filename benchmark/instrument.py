@@ -0,0 +1,75 @@
+'''Benchmark clinical data extraction: per-cell DataFrame.loc writes versus the row-batched builder
+
+Run from the repository root: python -m benchmark.instrument --subjects 500'''
+import argparse
+import filecmp
+import pathlib
+import tempfile
+import time
+from typing import Callable, Dict
+import pandas as pd
+
+import benchmark.generate
+import src.cdisc
+import src.export
+import src.REDCap.instrument
+import src.REDCap.utils
+
+
+def loc_dataframe(records: Dict[str, list], columns: pd.MultiIndex, *args) -> pd.DataFrame:
+    '''previous implementation, fill an empty MultiIndex DataFrame one cell at a time (no checkbox items, generate() default)'''
+    index = pd.MultiIndex.from_product([[],[]], names=['SubjectKey','FormRepeatKey'])
+    data = pd.DataFrame([], index=index, columns=columns)
+    for SubjectKey, FormRepeatKey, FormOID, ItemOID, Value in zip(*records.values()):
+        data.loc[(SubjectKey, FormRepeatKey), ([FormOID],[ItemOID])] = Value
+    return data
+
+def instrument_data_table(xml: src.cdisc.Cdisc, builder: Callable, output: pathlib.Path) -> float:
+    '''write all instruments with the given clinical data builder to output and return the time spent in the builder
+
+    output is a (new) temporary folder, the output_folder of src/config.ini is never touched'''
+    src.export.export.is_dir(output)
+    src.export.export.output_folder = str(output)
+
+    elapsed = []
+    def timed(records: Dict[str, list], columns: pd.MultiIndex, *args) -> pd.DataFrame:
+        start = time.perf_counter()
+        data = builder(records, columns, *args)
+        elapsed.append(time.perf_counter() - start)
+        return data
+
+    clinical_data_dataframe = src.REDCap.utils.clinical_data_dataframe
+    src.REDCap.utils.clinical_data_dataframe = timed
+    try:
+        src.REDCap.instrument.REDCapInstrument(xml).instrument_data_table()
+    finally:
+        src.REDCap.utils.clinical_data_dataframe = clinical_data_dataframe
+
+    return sum(elapsed)
+
+def main(subjects: int, instruments: int, fields: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        file = tmp.joinpath('benchmark.xml')
+        benchmark.generate.generate(file, subjects, instruments, fields)
+        print(f'{subjects} subjects, {instruments} instruments, {fields} fields ({file.stat().st_size / 1e6:.1f} MB)')
+        xml = src.cdisc.Cdisc(str(file), 'REDCap')
+
+        loc = instrument_data_table(xml, loc_dataframe, tmp.joinpath('loc'))
+        batched = instrument_data_table(xml, src.REDCap.utils.clinical_data_dataframe, tmp.joinpath('batched'))
+
+        files = [f'instrument_{i}.csv' for i in range(instruments)]
+        match, mismatch, errors = filecmp.cmpfiles(tmp.joinpath('loc'), tmp.joinpath('batched'), files, shallow=False)
+
+    print(f'DataFrame.loc: {loc:.2f}s')
+    print(f'row-batched:   {batched:.2f}s ({loc / batched:.0f}x)')
+    print(f'identical output: {len(match)}/{len(files)} instruments')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--subjects', type=int, default=500)
+    parser.add_argument('--instruments', type=int, default=5)
+    parser.add_argument('--fields', type=int, default=20)
+    args = parser.parse_args()
+    main(args.subjects, args.instruments, args.fields)
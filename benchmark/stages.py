@@ -0,0 +1,114 @@
+'''Benchmark the transform stages (parse, datamodel, instruments, codelists) at several sizes
+
+Run from the repository root: python -m benchmark.stages --subjects 100 1000 5000 --output benchmark-results.json
+
+Each size is generated with benchmark/generate.py, every stage is timed and, in a second run under
+tracemalloc, its peak (Python) memory is measured. Results are written as JSON to track regressions.'''
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import pathlib
+import platform
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+import pandas as pd
+
+import benchmark.generate
+import src.cdisc
+import src.codelist
+import src.datamodel
+import src.export
+import src.instrument
+
+EDC = 'REDCap'
+
+
+def stages(file: pathlib.Path, parser: str) -> Dict[str, Callable]:
+    '''the stages of run.Transform, in order, sharing the parsed document'''
+    xml = {}
+    def parse() -> None:
+        xml['xml'] = src.cdisc.Cdisc(str(file), EDC, parser=parser)
+    return {
+        'parse': parse,
+        'datamodel': lambda: src.datamodel.datamodel(EDC, xml['xml']),
+        'instruments': lambda: src.instrument.instruments(EDC, xml['xml']),
+        'codelists': lambda: src.codelist.codelists(EDC, xml['xml'])
+    }
+
+def run(file: pathlib.Path, output: pathlib.Path, parser: str, memory: bool) -> Dict[str, Dict[str, float]]:
+    '''run every stage, return seconds and (if memory) peak MB per stage'''
+    if output.is_dir():
+        src.export.export.is_empty(output)
+    else:
+        src.export.export.is_dir(output)
+    src.export.export.output_folder = str(output)
+    result = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, stage in stages(file, parser).items():
+            if memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            stage()
+            seconds = time.perf_counter() - start
+            if memory:
+                result[name] = {'peak_mb': round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 2)}
+                tracemalloc.stop()
+            else:
+                result[name] = {'seconds': round(seconds, 4)}
+    return result
+
+def main(subjects: List[int], instruments: int, fields: int, repeating: int, checkboxes: int, codelists: int,
+        parser: str, memory: bool, output: str) -> None:
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        for n in subjects:
+            file = tmp.joinpath(f'benchmark_{n}.xml')
+            benchmark.generate.generate(file, n, instruments, fields, repeating=repeating, checkboxes=checkboxes, codelists=codelists)
+            size = file.stat().st_size / 1024 ** 2
+
+            folder = tmp.joinpath(f'output_{n}')
+            timings = run(file, folder, parser, memory=False)
+            if memory:
+                for name, peak in run(file, folder, parser, memory=True).items():
+                    timings[name].update(peak)
+
+            runs.append({'subjects': n, 'file_mb': round(size, 2), 'stages': timings})
+            print(f'{n} subjects ({size:.1f} MB): ' + ', '.join(
+                f'{name} {t["seconds"]:.2f}s' + (f' {t["peak_mb"]:.0f} MB' if 'peak_mb' in t else '') for name, t in timings.items()))
+
+    results = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'parser': parser,
+        'instruments': instruments,
+        'fields': fields,
+        'repeating': repeating,
+        'checkboxes': checkboxes,
+        'codelists': codelists,
+        'runs': runs
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subjects', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--instruments', type=int, default=5)
+    parser.add_argument('--fields', type=int, default=20)
+    parser.add_argument('--repeating', type=int, default=1, help='number of repeating instruments')
+    parser.add_argument('--checkboxes', type=int, default=2, help='checkbox fields per instrument')
+    parser.add_argument('--codelists', type=int, default=2, help='radio/select fields per instrument')
+    parser.add_argument('--parser', default='etree', choices=list(src.cdisc.PARSERS))
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='only time the stages')
+    parser.add_argument('--output', default='benchmark-results.json')
+    args = parser.parse_args()
+    main(args.subjects, args.instruments, args.fields, args.repeating, args.checkboxes, args.codelists,
+        args.parser, args.memory, args.output)
@@ -1,13 +1,24 @@
 import configparser
+import glob
+import logging
+import multiprocessing
 import pathlib
+import time
 
 from enum import Enum
+from typing import Callable, Dict, Iterable, Union
 
+import src.cdisc
 import src.exceptions
 import src.export
 import src.datamodel
+import src.emx2
 import src.instrument
+import src.manifest
 import src.codelist
+import src.trace
+
+logger = logging.getLogger(__name__)
 
 
 class Edc(Enum):
@@ -17,8 +28,22 @@ class Edc(Enum):
     DUMMY = 'Dummy'
 
 class Transform():
-    '''Electronic Data Capture (EDC): REDCAP, CASTOR(not implemented), file: CDISC ODM (xml)'''
-    def __init__(self, edc: None = None, file: str = None) -> None:
+    '''Electronic Data Capture (EDC): REDCAP, CASTOR(not implemented), file: CDISC ODM (xml)
+
+    stream: read ClinicalData one SubjectData at a time instead of loading the whole document
+    workers: number of processes used to transform and write the instruments
+    output: output folder for this file, default output_folder from src/config.ini
+    incremental: keep the output of the previous run and only write the tables that changed (.manifest.json)
+    report: write the time, CPU time, peak memory and rows of every stage to this JSON file,
+    the same spans are logged when logging is at DEBUG level
+    staging: keep the ClinicalData in a temporary SQLite database instead of memory and build one instrument at a time,
+    True for the system temp folder or the folder to put it in, for files that do not fit in memory
+    forms: only transform these instruments (FormName or FormOID), the others are left out of every table
+    subjects: only transform these SubjectKeys, or the subjects for which this function of the SubjectKey is True
+    metadata_cache: folder to keep the datamodel and codelists of a data dictionary for later runs, default metadata_cache from src/config.ini'''
+    def __init__(self, edc: None = None, file: str = None, stream: bool = False, workers: int = 1, output: str = None, incremental: bool = False,
+            report: str = None, staging: Union[bool, str] = False, forms: Iterable[str] = None,
+            subjects: Union[Iterable[str], Callable[[str], bool]] = None, metadata_cache: str = None) -> None:
 
         config = configparser.ConfigParser()
         config.read('src/config.ini')
@@ -30,28 +55,142 @@ class Transform():
 
         if not file.is_file():
             raise src.exceptions.NoFile()
+
+        # reject files that are not an ODM export with ClinicalData before parsing or writing anything
+        src.cdisc.preflight(file)
         
-        output_folder = pathlib.Path().joinpath(config['settings']['output_folder'])
-        src.export.export.is_dir(output_folder)
-        src.export.export.is_empty(output_folder)
+        # fail before writing anything if the columnar copy (config.ini) cannot be written
+        if src.export.export.columnar:
+            src.export.export.pyarrow()
+        # or a [redcap.datatype] rule in config.ini is invalid
+        src.emx2.Emx2.datatype_list()
 
         if (edc not in Edc._value2member_map_):
             raise src.exceptions.NoValidEdc()
 
-        print(f'Running {edc}')
-        print(f'Processing {file}')
-        print('**data model**')
-        src.datamodel.datamodel(edc, file)
-        print('**instruments**')
-        src.instrument.instruments(edc, file)
-        print('**codelists**')
-        src.codelist.codelists(edc, file)
+        logger.info(f'Running {edc}')
+        logger.info(f'Processing {file}')
+
+        # spans cost nothing unless a report is asked for or logging is at DEBUG level
+        tracer = src.trace.tracer = src.trace.Tracer(report is not None or src.trace.logger.isEnabledFor(logging.DEBUG))
+        parse_count = src.cdisc.Cdisc.parse_count
+
+        with tracer.span('transform', file=str(file)):
+            # parse the file once and share the document with every stage
+            with tracer.span('parse'):
+                xml = src.cdisc.Cdisc(file, edc, stream=stream, forms=forms, subjects=subjects, metadata_cache=metadata_cache)
+
+            # the output folder is only created or emptied once the file and the forms selection are valid
+            output_folder = pathlib.Path().joinpath(output or config['settings']['output_folder'])
+            src.export.export.is_dir(output_folder)
+            src.export.export.output_folder = str(output_folder)
+
+            # a zip bundle is always written as a whole
+            manifest = None
+            if incremental and not src.export.export.bundled():
+                manifest = src.manifest.Manifest(output_folder)
+            if not (manifest and manifest.compatible()):
+                src.export.export.is_empty(output_folder)
+
+            logger.info('**data model**')
+            with tracer.span('datamodel'):
+                xml.refresh()
+                src.datamodel.datamodel(edc, xml, manifest)
+            logger.info('**instruments**')
+            with tracer.span('instruments'):
+                xml.refresh()
+                src.instrument.instruments(edc, xml, workers, manifest, staging)
+            logger.info('**codelists**')
+            with tracer.span('codelists'):
+                xml.refresh()
+                src.codelist.codelists(edc, xml, manifest)
+            if manifest:
+                manifest.save()
+
+        self.parse_count = src.cdisc.Cdisc.parse_count - parse_count
+        logger.info(f'Parsed {file} {self.parse_count} time(s)')
+        if report:
+            tracer.write(report)
+
+def transform_file(edc: str, file: pathlib.Path, output: pathlib.Path, stream: bool, incremental: bool,
+        staging: Union[bool, str] = False, forms: Iterable[str] = None, subjects: Iterable[str] = None,
+        metadata_cache: str = None) -> Dict[str, object]:
+    '''Transform a single file in a batch, never raises, returns status, duration (s) and peak memory (MB)'''
+    start = time.perf_counter()
+    try:
+        Transform(edc = edc, file = str(file), stream = stream, output = str(output), incremental = incremental, staging = staging,
+            forms = forms, subjects = subjects, metadata_cache = metadata_cache)
+        status, error = 'ok', ''
+    except Exception as e: # a failing file must not stop the batch, Ctrl-C (KeyboardInterrupt) does
+        status, error = 'failed', str(e) or type(e).__name__
+    return {
+        'file': file.name,
+        'status': status,
+        'error': error,
+        'duration': time.perf_counter() - start,
+        'memory': src.trace.peak_rss()
+    }
+
+class Batch():
+    '''Transform every CDISC ODM file in a directory (*.xml) or matching a glob pattern
+
+    Every file gets its own output subdirectory (output/<file name>) and runs in its own process,
+    workers processes side by side. A failing file is reported in the summary and does not stop the batch.
+    forms and subjects select part of every file as in Transform, subjects as SubjectKeys only (a function can not be sent to a process)'''
+    def __init__(self, edc: str = 'REDCap', input: str = None, output: str = None, workers: int = 1, stream: bool = False, incremental: bool = False,
+            staging: Union[bool, str] = False, forms: Iterable[str] = None, subjects: Iterable[str] = None,
+            metadata_cache: str = None) -> None:
+
+        config = configparser.ConfigParser()
+        config.read('src/config.ini')
+
+        input = pathlib.Path(input or config['settings']['input_folder'])
+        if input.is_dir():
+            files = sorted(input.glob('*.xml'))
+        else:
+            files = sorted(pathlib.Path(f) for f in glob.glob(str(input)))
+        if not files:
+            raise src.exceptions.NoFile()
+
+        if (edc not in Edc._value2member_map_):
+            raise src.exceptions.NoValidEdc()
+
+        output_folder = pathlib.Path(output or config['settings']['output_folder'])
+        output_folder.mkdir(parents=True, exist_ok=True)
+
+        jobs = [(edc, file.resolve(), output_folder.joinpath(file.stem), stream, incremental, staging, forms, subjects, metadata_cache)
+            for file in files]
+
+        # a fresh process per file, peak memory is per file and a crash only takes that file down
+        with multiprocessing.Pool(processes=workers, maxtasksperchild=1) as pool:
+            self.results = pool.starmap(transform_file, jobs, chunksize=1)
+
+        self.summary()
+
+    def summary(self) -> None:
+        '''print status, duration and peak memory per file'''
+        print(f'{"status":<8}{"duration":>10}{"peak memory":>14}  file')
+        for result in self.results:
+            memory = f'{result["memory"]:.1f} MB' if result['memory'] is not None else 'n/a'
+            error = f' ({result["error"]})' if result['error'] else ''
+            print(f'{result["status"]:<8}{result["duration"]:>9.2f}s{memory:>14}  {result["file"]}{error}')
+        failed = sum(result['status'] != 'ok' for result in self.results)
+        print(f'{len(self.results)} file(s), {failed} failed')
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     Transform(edc = 'REDCap', file = 'Example_1_REDCap_meta.xml')
     #Transform(edc = 'REDCap', file = 'Example_2_REDCap_repeated-measures.xml')
     #Transform(edc = 'REDCap', file = 'Example_3_TestHumanCancer_REDCap.xml')
     #Transform(edc = 'REDCap', file = 'Example_5_missing-clinical-data.xml')
+    #Transform(edc = 'REDCap', file = 'Example_4_TestHumanCancer_data_REDCap.xml', stream = True)
+    #Transform(edc = 'REDCap', file = 'Example_4_TestHumanCancer_data_REDCap.xml', workers = 4)
+    #Batch(edc = 'REDCap', input = 'data/input', output = 'data/output/batch', workers = 4)
+    #Transform(edc = 'REDCap', file = 'Example_4_TestHumanCancer_data_REDCap.xml', incremental = True)
+    #Transform(edc = 'REDCap', file = 'Example_4_TestHumanCancer_data_REDCap.xml', report = 'data/output/report.json')
+    #Transform(edc = 'REDCap', file = 'Example_4_TestHumanCancer_data_REDCap.xml', stream = True, staging = True)
+    #Transform(edc = 'REDCap', file = 'Example_4_TestHumanCancer_data_REDCap.xml', forms = ['demographics'], subjects = lambda key: key.startswith('1'))
+    #Transform(edc = 'REDCap', file = 'Example_4_TestHumanCancer_data_REDCap.xml', metadata_cache = 'data/cache')
     #Transform(edc = Edc.CASTOR, file = 'testC.xml')
     #Transform(edc = Edc.DUMMY, file = 'test.xml')
     #Transform(edc = 'REDCap', file='test.xml')
@@ -44,47 +44,111 @@
 # Resources
 # pid, name, localName, acronym, website, description, keywords, contributors, externalIdentifiers, institution, logo, numberOfParticipants, numberOfParticipanstWithSamples, countries, regions, ..
 import configparser
+import logging
+import re
+from typing import Dict, Iterator, List, Tuple
 import pandas as pd
 
 import src.cdisc
+import src.export
+import src.manifest
+import src.REDCap.utils
 #from cdisc import Cdisc
 
+logger = logging.getLogger(__name__)
+
 class REDCapCodelist:
 	config = configparser.ConfigParser()
 	config.read('./src/config.ini')
 
 	ns = config['redcap']['namespace']
 	output_folder = config['settings']['output_folder']
+	variable_values_name = 'VariableValues'
+
+	def __init__(self, xml: src.cdisc.Cdisc, manifest: src.manifest.Manifest = None) -> None:
+		self.xml = xml
+		self.file = xml.file
+		self.manifest = manifest
+
+	def coded_variables(self) -> List[Tuple[str, str, str, List[Tuple[str, str]]]]:
+		'''returns tableName, variable, FieldType and its (code, label) choices for every variable with a CodeList (metadata cache)'''
+		return self.xml.metadata('coded_variables', lambda: list(self.iter_coded_variables()))
+
+	def iter_coded_variables(self) -> Iterator[Tuple[str, str, str, List[Tuple[str, str]]]]:
+		'''yield tableName, variable, FieldType and its (code, label) choices for every variable with a CodeList
+
+		one pass over the ItemRefs of the index (instrument order), no query per variable. The items of a checkbox
+		(variable___1, variable___2 ..) are one variable, its choices are the CheckboxChoices of the CodeList'''
+		index = self.xml.index
+
+		# the items of a variable, in order: a checkbox has one item per choice
+		variables = {}
+		for item_group, item_refs in index.item_group_defs.items():
+			tableName = item_group.split('.')[0]
+			for item in [item['ItemOID'] for item in item_refs]:
+				if index.item_def(item, 'CodeListOID') is None:
+					continue
+				FieldType = index.item_def(item, self.ns + 'FieldType')
+				variable = re.sub(r'___\d+$', '', item) if FieldType == 'checkbox' else item
+				variables.setdefault((tableName, variable, FieldType), []).append(item)
+
+		for (tableName, variable, FieldType), items in variables.items():
+			codelist = index.item_def(items[0], 'CodeListOID')
+			if FieldType == 'checkbox':
+				yield tableName, variable, FieldType, src.REDCap.utils.checkbox_choices(self.xml, self.ns, codelist, items)
+			else:
+				yield tableName, variable, FieldType, [(i['CodedValue'], i['Decode']) for i in index.codelists.get(codelist, [])]
+
+	def variable_values(self) -> pd.DataFrame:
+		'''VariableValues: variable, value, label and order of every coded variable, booleans as written to the instruments (TRUE/FALSE)'''
+		records = []
+		for _, variable, FieldType, choices in self.coded_variables():
+			for order, (code, label) in enumerate(choices, start=1):
+				if FieldType in ('yesno', 'truefalse'):
+					code = src.REDCap.utils.boolean_values.get(code, code)
+				records.append({'variable': variable, 'value': code, 'label': label, 'order': order})
+		return pd.DataFrame(records, columns=['variable', 'value', 'label', 'order'])
+
+	def ref_tables(self) -> Dict[str, pd.DataFrame]:
+		'''ontology style tables (name, label, code, order) the ref (yesno, truefalse) and ref_array (checkbox) columns refer to'''
+		tables = {}
+		for tableName, variable, FieldType, choices in self.coded_variables():
+			name = src.REDCap.utils.ref_table_name(tableName, variable, FieldType)
+			if name is None or name in tables:
+				continue
+			tables[name] = pd.DataFrame([{
+				'name': src.REDCap.utils.boolean_values.get(code, code) if FieldType != 'checkbox' else code,
+				'label': label,
+				'code': code,
+				'order': order
+			} for order, (code, label) in enumerate(choices, start=1)], columns=['name', 'label', 'code', 'order'])
+		return tables
+
+	def datamodel(self) -> pd.DataFrame:
+		'''molgenis.csv rows of the ref tables and VariableValues'''
+		def table(tableName: str, key: List[str], columns: List[str]) -> List[Dict[str, str]]:
+			return [{'tableName': tableName}] + [{
+				'tableName': tableName,
+				'columnName': column,
+				'columnType': 'int' if column == 'order' else None,
+				'key': '1' if column in key else None,
+				'required': 'TRUE' if column in key else None
+			} for column in columns]
+
+		records = []
+		for name in self.ref_tables():
+			records.extend(table(name, ['name'], ['name', 'label', 'code', 'order']))
+		records.extend(table(self.variable_values_name, ['variable', 'value'], ['variable', 'value', 'label', 'order']))
+		result = src.REDCap.utils.datamodel_table(records)
+		return result.drop(columns=['DataType','FieldType','TextValidationType'])
 
-	def __init__(self, file: str) -> None:
-		self.file = file
-	
 	def codelist_data_table(self) -> None:
-		'''retrieve codelist (molgenis variables) data'''
-		xml = src.cdisc.Cdisc(self.file, 'REDCap')
-
-		def get_forms(self) -> pd.DataFrame:
-			'''Returns a pandas DataFrame with to columns: OID, FormName'''
-			# determine which forms are included and need to be extracted
-			return pd.concat([
-				pd.Series(src.cdisc.Cdisc.attribute_values(xml, './/odm:FormDef', 'OID'), name='OID'), 
-				pd.Series(src.cdisc.Cdisc.attribute_values(xml, './/odm:FormDef', self.ns + 'FormName'), name='FormName')], axis=1)
-		
-		#print(get_forms(self))
-
-		def get_item_group_def(self) -> pd.DataFrame:
-			'''Returns a pandas DataFrame with to columns: OID, FormName'''
-			# determine which forms are included and need to be extracted
-			return pd.Series(src.cdisc.Cdisc.attribute_values(xml, './/odm:ItemGroupDef', 'OID'), name='OID')
-		
-		#print(get_item_group_def(self))
-
-		def get_item_def(self) -> pd.DataFrame:
-			'''Returns a pandas DataFrame with to columns: OID, FormName'''
-			# determine which forms are included and need to be extracted
-			return pd.concat([
-				#pd.Series(Cdisc.attribute_values(xml, './/odm:ItemDef', 'OID'), name='OID'),
-				#pd.Series(Cdisc.element_text(xml, './/odm:ItemDef'), name='text')])
-				pd.Series(src.cdisc.Cdisc.element_text(xml, './/odm:ItemDef/odm:Question/odm:TranslatedText'), name='text')])
-
-		print(get_item_def(self))
\ No newline at end of file
+		'''write the ref tables and VariableValues'''
+		tables = {**self.ref_tables(), self.variable_values_name: self.variable_values()}
+		for name, data in tables.items():
+			file = f'{name}.csv'
+			if self.manifest and self.manifest.unchanged(file, src.manifest.digest(data.to_csv(index=False))):
+				logger.info(f'Unchanged {file}')
+				continue
+			logger.info(f'Writing {file}')
+			src.export.export.instrument_to_csv(data, file)
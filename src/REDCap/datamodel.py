@@ -1,19 +1,24 @@
 '''Get dataframe from REDCap CDISC ODM and convert to datamodel aka molgenis.csv'''
 import configparser
+import logging
 import re
-from typing import Dict
+from typing import Dict, List
 import pandas as pd
 
 import src.cdisc
 import src.emx2
 import src.export
+import src.manifest
 import src.REDCap.utils
+import src.trace
 #from cdisc import Cdisc
 #from emx2 import Emx2
 #from export import export
 
 #from REDCap.utils import defined_instruments, datamodel_table_columns
 
+logger = logging.getLogger(__name__)
+
 
 class REDCapDatamodel:
     config = configparser.ConfigParser()
@@ -23,139 +28,140 @@ class REDCapDatamodel:
     datamodel = config['settings']['datamodel']
     subject_data_name = config['settings']['subject'].split(".")[0]
 
-    def __init__(self, file: str) -> None:
-        self.file = file
+    def __init__(self, xml: src.cdisc.Cdisc) -> None:
+        self.xml = xml
+        self.file = xml.file
     
-    def subject_data(self) -> None:
-        self.generate_subjectdata()
+    def subject_data(self) -> pd.DataFrame:
+        return self.generate_subjectdata()
     
-    def instruments(self) -> None:
-        self.generate_instruments(to_csv = True, to_dataframe = False)
+    def instruments(self) -> pd.DataFrame:
+        return self.generate_instruments(to_csv = True, to_dataframe = False)
+
+    def write_datamodel(self, tables: List[pd.DataFrame], manifest: src.manifest.Manifest = None) -> None:
+        '''write the datamodel aka molgenis.csv once from its parts (SubjectData, instruments)'''
+        data = pd.concat(tables, ignore_index=True)
+        if manifest and manifest.unchanged(self.datamodel, src.manifest.digest(data.to_csv(index=False))):
+            logger.info(f'Unchanged {self.datamodel}')
+            return
+        with src.trace.span('write', table=self.datamodel) as span:
+            src.export.export.instrument_to_csv(data, self.datamodel)
+            span.rows = len(data)
 
-    def generate_subjectdata(self) -> None:
+    def generate_subjectdata(self) -> pd.DataFrame:
         #result = self.table_columns()
-        result = src.REDCap.utils.datamodel_table_columns()
-        result = result.append({'tableName': self.subject_data_name}, ignore_index=True)
-        result = result.append({
-            'tableName': self.subject_data_name,
-            'columnName': 'key',
-            'key': '1', 
-            'required': 'TRUE'}, ignore_index=True)
-        result = result.append({
-            'tableName': self.subject_data_name,
-            'columnName': 'SubjectKey',
-            'required': 'TRUE'}, ignore_index=True)
-        result = result.append({
-            'tableName': self.subject_data_name,
-            'columnName': 'FormRepeatKey',
-            'required': 'TRUE'}, ignore_index=True)
-        result = result.drop(columns=['DataType','FieldType','TextValidationType'])     
-        src.export.export.instrument_to_csv(result, self.datamodel)
-    
-    def generate_instruments(self, to_csv: bool = False, to_dataframe: bool = False) -> None:
-        '''generate intruments in datamodel aka molgenis.csv format'''
-        def instrument_table(dataframe: pd.DataFrame, instrument: str) -> pd.DataFrame:
-            '''instrument row returns pd.DataFrame'''
-            result = dataframe.append({'tableName': instrument}, ignore_index=True)
-            result = result.append({
-                'tableName': instrument,
+        records = [
+            {'tableName': self.subject_data_name},
+            {
+                'tableName': self.subject_data_name,
                 'columnName': 'key',
-                'columnType': 'ref',
-                'refTable': self.subject_data_name,
                 'key': '1', 
-                'required': 'TRUE'}, ignore_index=True)
-            result = result.append({
-                'tableName': instrument,
+                'required': 'TRUE'},
+            {
+                'tableName': self.subject_data_name,
                 'columnName': 'SubjectKey',
-                'required': 'TRUE'}, ignore_index=True)
-            result = result.append({
-                'tableName': instrument,
-                'columnName': 'FormRepeatKey'}, ignore_index=True)
-            return result
-        
-        
+                'required': 'TRUE'},
+            {
+                'tableName': self.subject_data_name,
+                'columnName': 'FormRepeatKey',
+                'required': 'TRUE'}
+        ]
+        result = src.REDCap.utils.datamodel_table(records)
+        result = result.drop(columns=['DataType','FieldType','TextValidationType'])     
+        return result
+    
+    def generate_instruments(self, to_csv: bool = False, to_dataframe: bool = False) -> pd.DataFrame:
+        '''generate intruments in datamodel aka molgenis.csv format
 
-        def dataframe_defined_instruments() -> pd.DataFrame:
-            result = src.REDCap.utils.datamodel_table_columns()
-            for instrument in src.REDCap.utils.defined_instruments(self.file, self.ns):
-                result = instrument_table(result, instrument)
-            return result
+        to_csv returns the molgenis.csv rows, to_dataframe keeps the REDCap columns
+
+        rows are collected as records and turned into a DataFrame once'''
+        def instrument_table(instrument: str) -> List[Dict[str, str]]:
+            '''instrument rows returns list of records'''
+            return [
+                {'tableName': instrument},
+                {
+                    'tableName': instrument,
+                    'columnName': 'key',
+                    'columnType': 'ref',
+                    'refTable': self.subject_data_name,
+                    'key': '1', 
+                    'required': 'TRUE'},
+                {
+                    'tableName': instrument,
+                    'columnName': 'SubjectKey',
+                    'required': 'TRUE'},
+                {
+                    'tableName': instrument,
+                    'columnName': 'FormRepeatKey'}
+            ]
+
+        def defined_instruments() -> List[Dict[str, str]]:
+            records = []
+            for instrument in src.REDCap.utils.defined_instruments(self.xml, self.ns):
+                records.extend(instrument_table(instrument))
+            return records
             
-        def dataframe_defined_variables(dataframe: pd.DataFrame) -> pd.DataFrame:
+        def defined_variables() -> List[Dict[str, str]]:
             ''''''
-            result = dataframe
-            xml = src.cdisc.Cdisc(self.file, 'REDCap')
-
-            def defined_variables() -> list:
-                '''return list of defined variables'''
-                return src.cdisc.Cdisc.attribute_values(xml, './/odm:ItemGroupDef', 'OID')
+            xml = self.xml
 
             def variable_description(variable: str) -> str:
                 '''return FieldNote for given variable'''
-                return src.cdisc.Cdisc.attribute_value(xml, ".//odm:ItemDef[@OID='"+ variable +"']", self.ns + 'FieldNote')
+                return xml.index.item_def(variable, self.ns + 'FieldNote')
             
             def variable_datatype(variable: str) -> str:
                 '''return DataType for given variable'''
-                return src.cdisc.Cdisc.attribute_value(xml, ".//odm:ItemDef[@OID='"+ variable +"']", 'DataType')
+                return xml.index.item_def(variable, 'DataType')
 
             def variable_fieldtype(variable: str) -> str:
                 '''return FieldType for given variable'''
-                return src.cdisc.Cdisc.attribute_value(xml, ".//odm:ItemDef[@OID='"+ variable +"']", self.ns + 'FieldType')
+                return xml.index.item_def(variable, self.ns + 'FieldType')
 
             def variable_textvalidationtype(variable: str) -> str:
                 '''return TextValidationType for given variable'''
-                return src.cdisc.Cdisc.attribute_value(xml, ".//odm:ItemDef[@OID='"+ variable +"']", self.ns + 'TextValidationType')
+                return xml.index.item_def(variable, self.ns + 'TextValidationType')
             
-            def variable_table(dataframe: pd.DataFrame, data: Dict[str, str]) -> pd.DataFrame:
-                '''variable row returns pd.DataFrame'''
-                return dataframe.append({
-                    'tableName': data['tableName'],
-                    'columnName': data['columnName'],
-                    'description': data['description'],
-                    'DataType': data['DataType'],
-                    'FieldType': data['FieldType'],
-                    'TextValidationType': data['TextValidationType']
-                }, ignore_index=True)
-            
-            def fetch_variable_field(dataframe: pd.DataFrame, variable_row: src.cdisc.Cdisc, tablename: str) -> pd.DataFrame:
-                '''fetch variable fields and return DataFrame'''
+            def fetch_variable_field(item_refs: List[Dict[str, str]], tablename: str) -> List[Dict[str, str]]:
+                '''fetch variable fields and return list of records'''
                 def collapse_multiple_choice(variable_str: str) -> str:
                     '''to collapse multiple choice to EMX format later'''
                     return re.sub('___\d+$', '', variable_str)
                 
-                result = dataframe
                 tablename = tablename.split('.')[0]
                 
-                for c in variable_row['ItemOID']:
-                    dict = {
-                        'tableName': tablename,
-                        'columnName': collapse_multiple_choice(c),
-                        'description': variable_description(c),
-                        'DataType': variable_datatype(c),
-                        'FieldType': variable_fieldtype(c),
-                        'TextValidationType': variable_textvalidationtype(c)
-                    }
-                    result = variable_table(result, dict)
-                return result
-
-            for variable in defined_variables():
-                variable_row = src.cdisc.Cdisc.attributes(xml, ".//odm:ItemGroupDef[@OID='"+ variable +"']/")
-                result = fetch_variable_field(result, variable_row, variable)
-            return result
+                return [{
+                    'tableName': tablename,
+                    'columnName': collapse_multiple_choice(c),
+                    'description': variable_description(c),
+                    'refTable': src.REDCap.utils.ref_table_name(tablename, collapse_multiple_choice(c), variable_fieldtype(c)),
+                    'DataType': variable_datatype(c),
+                    'FieldType': variable_fieldtype(c),
+                    'TextValidationType': variable_textvalidationtype(c)
+                } for c in [item['ItemOID'] for item in item_refs]]
 
-        # export to file or return dataframe
-        if to_csv:
-            result = dataframe_defined_instruments()
-            result = dataframe_defined_variables(result)
+            records = []
+            for variable, item_refs in xml.index.item_group_defs.items():
+                records.extend(fetch_variable_field(item_refs, variable))
+            return records
+
+        def molgenis_csv() -> pd.DataFrame:
+            result = src.REDCap.utils.datamodel_table(defined_instruments() + defined_variables())
             result = result.drop_duplicates(subset = ["columnName"]) # drop duplicates (from multiple choice questions)  
             result = src.emx2.Emx2.REDCap_datatype(result) # determine the emx2 datatype based on REDCAP DataType, FieldType and TextValidationType
             result = result.drop(columns=['DataType','FieldType','TextValidationType']) # remove REDCap columns
-            src.export.export.instrument_to_csv(result, self.datamodel)
+            return result
 
-        if to_dataframe:
-            result = dataframe_defined_instruments()
-            result = dataframe_defined_variables(result)
+        def dataframe() -> pd.DataFrame:
+            result = src.REDCap.utils.datamodel_table(defined_instruments() + defined_variables())
             #result = result.drop_duplicates(subset = ["columnName"]) # drop duplicates (from multiple choice questions)  
             result = src.emx2.Emx2.REDCap_datatype(result) # determine the emx2 datatype based on REDCAP DataType, FieldType and TextValidationType
             #result = result.drop(columns=['DataType','FieldType','TextValidationType']) # remove REDCap columns
             return result
+
+        # export to file or return dataframe, both only depend on the MetaDataVersion (metadata cache)
+        if to_csv:
+            return self.xml.metadata('datamodel.instruments.csv', molgenis_csv)
+
+        if to_dataframe:
+            return self.xml.metadata('datamodel.instruments', dataframe)
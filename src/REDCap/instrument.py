@@ -1,18 +1,110 @@
 '''Get data from REDCap CDISC ODM and convert to instrument tables'''
+import collections
+import concurrent.futures
 import configparser
+import itertools
+import logging
 import numpy as np
 import pandas as pd
-import sys
+from typing import Dict, Iterator, List, Tuple, Union
 
 import src.cdisc
+import src.exceptions
 import src.export
+import src.manifest
 import src.REDCap.datamodel
 import src.REDCap.utils
+import src.staging
+import src.trace
 #from REDCap.utils import defined_instruments, defined_repeating_instruments, study_contains_repeating_instrument, subject_keys, form_repeat_keys, subject_data_table_keys, subject_data_table_subject_keys, subject_data_table_form_repeat_keys, study_contains_study_event_data
 #from REDCap.datamodel import REDCapDatamodel
 #from cdisc import Cdisc
 #from export import export
 
+logger = logging.getLogger(__name__)
+
+
+def transform_redcap_boolean(instrument_data: pd.DataFrame, boolean_columns: set) -> pd.DataFrame:
+    '''Transform REDCap bool (0/1) to EMX2 TRUE/FALSE'''
+    data_copy = instrument_data.copy()
+    boolean = src.REDCap.utils.boolean_values
+
+    # REDCap variables defined as boolean (yesno, truefalse), coded (Categorical) ones by renaming their categories
+    for position in np.flatnonzero(instrument_data.columns.isin(boolean_columns)):
+        values = data_copy.iloc[:, position]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            data_copy.isetitem(position, values.cat.rename_categories(lambda c: boolean.get(c, c)))
+        else:
+            data_copy.isetitem(position, values.replace(boolean))
+    return data_copy
+    
+def instrument_csv_data(dataframe: pd.DataFrame, repeating: bool = False) -> pd.DataFrame:
+    '''Transform DataFrame to the 'instrument'.csv table'''
+    # drop columns SubjectKey and FormRepeatKey they are empty 
+    # and replaced by multiindex (SubjectKey and FormRepeatKey).
+
+    data = dataframe.copy()
+    
+    if 'SubjectKey' in data:
+        data.drop(['SubjectKey'], axis=1, inplace=True)
+        data.drop(['FormRepeatKey'], axis=1, inplace=True)
+        data.drop(['key'], axis=1, inplace=True)
+
+    # rows without any value for this instrument are dropped first, so the keys match the rows that are left
+    data.dropna(how='all', inplace=True)
+
+    # make sure each row has correct SubjectKey and FormRepeatKey
+    index = pd.DataFrame(
+        [keys for keys in data.index.values],
+        columns=['SubjectKey','FormRepeatKey']
+    )
+
+    repeatKey = index['SubjectKey'] + "_" + index['FormRepeatKey']
+    nonRepeatKey = index['SubjectKey'].unique() + "_1"
+
+    # insert SubjectKey and FormRepeatKey to instrument
+    # if instrument has no repeated measurements only use the first FormRepeatKey
+    # if instrument has repeated measures, add all FormRepeatKey(s)
+    if repeating:
+        data.insert(0, 'key', repeatKey.to_list())
+    else:
+        data.reset_index(drop=True, inplace=True)
+        data.insert(0, 'key', nonRepeatKey.tolist())
+    return data
+
+def write_instrument_csv(data: pd.DataFrame, instrument: str, output_folder: str = None, column_types: Dict[str, str] = None) -> None:
+    '''write 'instrument'.csv, and its typed columnar copy if columnar is set in config.ini'''
+    try:
+        src.export.export.instrument_to_csv(data, f'{instrument}.csv', output_folder)
+        if src.export.export.columnar:
+            src.export.export.instrument_to_columnar(data, f'{instrument}.csv', column_types, output_folder)
+    except src.exceptions.NoColumnar:
+        raise
+    except Exception as e:
+        raise src.exceptions.ErrorWritingInstrument(instrument) from e
+
+def export_instrument(instrument_data: pd.DataFrame, instrument: str, repeating: bool, boolean_columns: set, write: bool = True,
+        output_folder: str = None, tracer: src.trace.Tracer = None, column_types: Dict[str, str] = None) -> Tuple[pd.DataFrame, List[dict]]:
+    '''Transform and write a single instrument, module level so it can run in a worker process
+
+    column_types (columnName -> EMX2 columnType) types the columnar copy of the table
+    with write=False the table is returned instead, for the parent process to write (zip bundle)
+    output_folder and tracer are passed explicitly, a worker process does not see the ones set by run.Transform,
+    the spans of the tracer are returned for the parent to attach'''
+    tracer = tracer or src.trace.tracer
+    data = None
+    with tracer.span('instrument', instrument=instrument):
+        with tracer.span('transform') as span:
+            data = instrument_csv_data(transform_redcap_boolean(instrument_data, boolean_columns), repeating)
+            span.rows = len(data)
+        if write:
+            logger.info(f'Writing {instrument}.csv')
+            with tracer.span('write') as span:
+                write_instrument_csv(data, instrument, output_folder, column_types)
+                span.rows = len(data)
+            data = None
+    return data, tracer.spans
+
 
 class REDCapInstrument():
     config = configparser.ConfigParser()
@@ -23,33 +115,92 @@ class REDCapInstrument():
     subject_data_csv = config['settings']['subject']
     subject_data_name = config['settings']['subject'].split(".")[0]
 
-    def __init__(self, file: str) -> None:
-        self.file = file
+    def __init__(self, xml: src.cdisc.Cdisc, workers: int = 1, manifest: src.manifest.Manifest = None, staging: Union[bool, str] = False) -> None:
+        self.xml = xml
+        self.file = xml.file
+        self.workers = workers
+        self.manifest = manifest
+        self.staging = staging
 
     def subject_data_table(self) -> None:
         '''setup SubjectData table, contains the keys that is a combination of SubjectKey and FormRepeatKey (1_1, 1_2 ..)'''
         def subject_data_table_dataframe(self) -> pd.DataFrame:
             '''combine keys, subject keys and form repeat keys and return SubjectData pd.dataframe'''
-            return pd.DataFrame({
-                'key': src.REDCap.utils.subject_data_table_keys(self.file),
-                'SubjectKey': src.REDCap.utils.subject_data_table_subject_keys(self.file),
-                'FormRepeatKey': src.REDCap.utils.subject_data_table_form_repeat_keys(self.file)
-            })
+            data = pd.DataFrame(src.REDCap.utils.subject_data_pairs(self.xml), columns=['SubjectKey', 'FormRepeatKey'])
+            data.insert(0, 'key', data['SubjectKey'] + '_' + data['FormRepeatKey'])
+            return data
 
-        src.export.export.instrument_to_csv(subject_data_table_dataframe(self), self.subject_data_csv)
+        with src.trace.span('SubjectData') as span:
+            data = subject_data_table_dataframe(self)
+            span.rows = len(data)
+            if self.manifest and self.manifest.unchanged(self.subject_data_csv, src.manifest.digest(data.to_csv(index=False)), columnar=True):
+                logger.info(f'Unchanged {self.subject_data_csv}')
+                return
+            src.export.export.instrument_to_csv(data, self.subject_data_csv)
+            if src.export.export.columnar:
+                src.export.export.instrument_to_columnar(data, self.subject_data_csv)
 
     def instrument_data_table(self) -> None:
         '''retrieve instrument data'''
-        xml = src.cdisc.Cdisc(self.file, 'REDCap')
+        xml = self.xml
 
-        #instruments = defined_instruments(self.file, self.ns)
+        #instruments = defined_instruments(self.xml, self.ns)
         
+        def clinical_data_no_repeats() -> Iterator[Tuple[str, str, str, str, str]]:
+            '''Retrieve clinicaldata items from study without repeated measurements'''
+            for SubjectKey, Subject in xml.iter_subjects():
+
+                for i in itertools.chain.from_iterable(Subject):
+                        if not xml.form_selected(i):
+                            continue
+                        for j in i:
+                            for k in j:
+                                # in case of images or files a value attribute does not exists
+                                # TODO
+                                # images/files
+                                yield SubjectKey, i.attrib['FormRepeatKey'], i.attrib['FormOID'], k.attrib['ItemOID'], k.attrib.get('Value', '')
+
+        def clinical_data_repeats() -> Iterator[Tuple[str, str, str, str, str]]:
+            '''Retrieve clinicaldata items from study with repeated measurements'''
+            for SubjectKey, Subject in xml.iter_subjects():
+
+                for i in itertools.chain.from_iterable(Subject):
+                    for j in i:
+                        if not xml.form_selected(j):
+                            continue
+                        for k in j:
+                            for l in k:
+                                yield SubjectKey, j.attrib['FormRepeatKey'], j.attrib['FormOID'], l.attrib['ItemOID'], l.attrib.get('Value', '')
+
+        # staging: the items go to an on-disk store instead of memory, instruments are built one at a time
+        store = src.staging.Staging(None if self.staging is True else self.staging) if self.staging else None
+        records = None
+        try:
+            with src.trace.span('extract') as span:
+                if src.REDCap.utils.study_contains_study_event_data(self.xml):
+                    items = clinical_data_repeats()
+                else:
+                    items = clinical_data_no_repeats()
+                if store:
+                    store.load(items)
+                    span.rows = store.count
+                else:
+                    records = src.REDCap.utils.clinical_data_records(items)
+                    span.rows = len(records['Value'])
+            self.export_instruments(records, store)
+        finally:
+            if store:
+                store.close()
+
+    def export_instruments(self, records: Dict[str, list], store: src.staging.Staging = None) -> None:
+        '''build, transform and write the instrument tables from the clinical data records, or form by form from the staging store'''
+        xml = self.xml
+
         def get_forms(self) -> pd.DataFrame:
             '''Returns a pandas DataFrame with to columns: OID, FormName'''
             # determine which forms are included and need to be extracted
-            return pd.concat([
-                pd.Series(src.cdisc.Cdisc.attribute_values(xml, './/odm:FormDef', 'OID'), name='OID'), 
-                pd.Series(src.cdisc.Cdisc.attribute_values(xml, './/odm:FormDef', self.ns + 'FormName'), name='FormName')], axis=1)
+            return pd.DataFrame(
+                [(oid, form.get(self.ns + 'FormName')) for oid, form in xml.index.form_defs.items()], columns=['OID', 'FormName'])
         
         def form_variables(self, dataframe: pd.DataFrame) -> pd.DataFrame:
             '''Returns a pandas DataFrame with two columns: FormOID, ItemOID of all Forms used by the Study'''
@@ -62,123 +213,109 @@ class REDCapInstrument():
 
             v.rename(columns={'OID': 'FormOID', 'columnName': 'ItemOID'}, inplace=True)
 
-            return v
+            # the items of a checkbox (variable___1 ..) are one column, the collapsed ref_array
+            return v.drop_duplicates()
         
-        def dataframe_multiindex():
-            '''setup data MultiIndex DataFrame'''
-            dataframe = src.REDCap.datamodel.REDCapDatamodel.generate_instruments(self, to_csv = False, to_dataframe = True)
-            columns = pd.MultiIndex.from_frame(form_variables(self, dataframe))
-            index = pd.MultiIndex.from_product([[],[]], names=['SubjectKey','FormRepeatKey'])
-            return pd.DataFrame([], index=index, columns=columns)
+        def dataframe_columns(dataframe: pd.DataFrame) -> pd.MultiIndex:
+            '''setup data MultiIndex columns (FormOID, ItemOID)'''
+            return pd.MultiIndex.from_frame(form_variables(self, dataframe))
 
-        def clinical_data_no_repeats(subject_keys: np.ndarray, data: pd.DataFrame) -> pd.DataFrame:
-            '''Retrieve clinicaldata from study without repeated measurements'''
-            for SubjectKey in subject_keys:
-
-                SubjectData = src.cdisc.Cdisc.iterfind(xml, ".//odm:SubjectData[@SubjectKey='"+SubjectKey+"']/")
-
-                for i in SubjectData:
-                        for j in i:
-                            for k in j:
-                                try:
-                                    data.loc[(SubjectKey,i.attrib['FormRepeatKey']),
-                                        ([i.attrib['FormOID']],[k.attrib['ItemOID']])] = k.attrib['Value']
-                                except KeyError:
-                                    # in case of images or files a value attribute does not exists
-                                    # TODO
-                                    # images/files
-                                    data.loc[(SubjectKey,i.attrib['FormRepeatKey']),
-                                        ([i.attrib['FormOID']],[k.attrib['ItemOID']])] = ''
-            return data
-
-        def clinical_data_repeats(subject_keys: np.ndarray, data: pd.DataFrame) -> pd.DataFrame:
-            '''Retrieve clinicaldata from study with repeated measurements'''
-            for SubjectKey in subject_keys:
-
-                SubjectData = src.cdisc.Cdisc.iterfind(xml, ".//odm:SubjectData[@SubjectKey='"+SubjectKey+"']/")
-
-                for i in SubjectData:
-                    for j in i:
-                        for k in j:
-                            for l in k:
-                                data.loc[(SubjectKey,j.attrib['FormRepeatKey']),
-                                    ([j.attrib['FormOID']],[l.attrib['ItemOID']])] = l.attrib['Value']
-            return data
-      
-        def transform_redcap_boolean(instrument_data: pd.DataFrame) -> pd.DataFrame:
-            '''Transform REDCap bool (0/1) to EMX2 TRUE/FALSE'''
-            df = src.REDCap.datamodel.REDCapDatamodel.generate_instruments(self, to_csv = False, to_dataframe = True)
-            
-            field_types: list = ['truefalse', 'yesno']
-            columns = list(instrument_data.columns)
-
-            data_copy = instrument_data.copy()
-
-            # see if REDCap variable is defined as boolean
-            for c_name in columns:          
-                # check if variable (c) is defined as boolean and one of the field_types
-                for f_type in field_types:
-                    row = df.loc[
-                        (df['DataType'] == 'boolean') & 
-                        (df['FieldType'] == f_type) & 
-                        (df['columnName'] == c_name)]
-                    
-                    if row.index.notnull():
-                        data_copy[c_name] = data_copy[c_name].replace(['0'],'FALSE')
-                        data_copy[c_name] = data_copy[c_name].replace(['1'],'TRUE')
-            return data_copy
-            
-        def write_instrument_csv(dataframe: pd.DataFrame, instrument: str, repeating: bool = False) -> None:
-            '''Transform DataFrame and write 'instrument'.csv'''
-            # drop columns SubjectKey and FormRepeatKey they are empty 
-            # and replaced by multiindex (SubjectKey and FormRepeatKey).
-
-            data = dataframe.copy()
-            
-            if 'SubjectKey' in data:
-                data.drop(['SubjectKey'], axis=1, inplace=True)
-                data.drop(['FormRepeatKey'], axis=1, inplace=True)
-                data.drop(['key'], axis=1, inplace=True)
-
-            # make sure each row has correct SubjectKey and FormRepeatKey
-            index = pd.DataFrame(
-                [keys for keys in data.index.values],
-                columns=['SubjectKey','FormRepeatKey']
-            )
-
-            repeatKey = index['SubjectKey'] + "_" + index['FormRepeatKey']
-            nonRepeatKey = index['SubjectKey'].unique() + "_1"
-
-            # insert SubjectKey and FormRepeatKey to instrument
-            # if instrument has no repeated measurements only use the first FormRepeatKey
-            # if instrument has repeated measures, add all FormRepeatKey(s)
-            if repeating:
-                data.dropna(how='all', inplace=True)
-                data.insert(0, 'key', repeatKey.to_list())
-            else:
-                data.dropna(how='all', inplace=True)
-                data.reset_index(drop=True, inplace=True)
-                data.insert(0, 'key', nonRepeatKey.tolist())
-            try:
-                print(f'Writing {instrument}.csv')
-                src.export.export.instrument_to_csv(data, f'{instrument}.csv')
-            except:
-                sys.exit(f'Writing {instrument}.csv failed, exiting.')
-        
-        if src.REDCap.utils.study_contains_study_event_data(self.file):
-            clinical_data = clinical_data_repeats(src.REDCap.utils.subject_keys(self.file), dataframe_multiindex())
-        else:
-            clinical_data = clinical_data_no_repeats(src.REDCap.utils.subject_keys(self.file), dataframe_multiindex())
+        datamodel = src.REDCap.datamodel.REDCapDatamodel.generate_instruments(self, to_csv = False, to_dataframe = True)
+        boolean_columns = src.REDCap.utils.boolean_columns(datamodel)
+        column_types = src.REDCap.utils.column_types(datamodel)
 
         instruments = get_forms(self)
         
+        contains_repeating_instrument = src.REDCap.utils.study_contains_repeating_instrument(self.xml, self.ns)
+        repeating_instruments = src.REDCap.utils.defined_repeating_instruments(self.xml, self.ns)
+
+        forms = []
         for i in instruments.index:
             instrument_name = instruments['FormName'][i]
-            instrument_data = clinical_data[instruments['OID'][i]]
-            transformed_clinical_data = transform_redcap_boolean(instrument_data)
 
-            if src.REDCap.utils.study_contains_repeating_instrument(self.file, self.ns):
-                if instrument_name in src.REDCap.utils.defined_repeating_instruments(self.file, self.ns):
-                    write_instrument_csv(transformed_clinical_data, instrument_name, True)
+            if contains_repeating_instrument:
+                if instrument_name in repeating_instruments:
+                    forms.append((instruments['OID'][i], instrument_name, True))
             else:
-                write_instrument_csv(transformed_clinical_data, instrument_name, False)
\ No newline at end of file
+                forms.append((instruments['OID'][i], instrument_name, False))
+
+        checkboxes = src.REDCap.utils.checkbox_items(self.xml, self.ns)
+
+        # incremental: skip instruments whose definition and clinical data are the same as in the previous run
+        # the checkbox choice codes are part of the definition, they become the values of the collapsed checkboxes
+        if self.manifest:
+            digests = src.REDCap.utils.clinical_data_digests(store.items() if store else zip(*records.values()))
+            changed = []
+            for FormOID, instrument_name, repeating in forms:
+                definition = datamodel[datamodel['tableName'] == instrument_name]
+                variables = set(definition['columnName'])
+                codes = [(item, code) for item, (variable, code) in checkboxes.items() if variable in variables]
+                digest = src.manifest.digest(definition.to_csv(index=False), codes, digests.get(FormOID), repeating)
+                if self.manifest.unchanged(f'{instrument_name}.csv', digest, columnar=True):
+                    logger.info(f'Unchanged {instrument_name}.csv')
+                else:
+                    changed.append((FormOID, instrument_name, repeating))
+            forms = changed
+            if not forms:
+                return
+
+        columns = dataframe_columns(datamodel)
+        columns = columns[columns.get_level_values(0).isin([FormOID for FormOID, _, _ in forms])]
+        item_types = {columnName: columnType for types in column_types.values() for columnName, columnType in types.items()}
+
+        def form_data(clinical_data: pd.DataFrame, FormOID: str) -> pd.DataFrame:
+            '''columns of a form by position, clinical_data[FormOID] reindexes a mixed dtype frame and fails on repeated columns'''
+            return clinical_data.iloc[:, clinical_data.columns.get_level_values(0) == FormOID].droplevel(0, axis=1)
+
+        def clinical_data_exports() -> List[Tuple[pd.DataFrame, str, bool]]:
+            '''pivot all forms at once'''
+            with src.trace.span('pivot') as span:
+                clinical_data = src.REDCap.utils.clinical_data_dataframe(records, columns, checkboxes)
+                span.rows = len(clinical_data)
+            records.clear()
+            with src.trace.span('compact'):
+                clinical_data = src.REDCap.utils.compact_clinical_data(clinical_data, self.xml, item_types)
+            return [(form_data(clinical_data, FormOID), instrument_name, repeating) for FormOID, instrument_name, repeating in forms]
+
+        def staged_exports() -> Iterator[Tuple[pd.DataFrame, str, bool]]:
+            '''query and pivot one form at a time, only the instrument that is being written is in memory'''
+            for FormOID, instrument_name, repeating in forms:
+                with src.trace.span('pivot', instrument=instrument_name) as span:
+                    form_columns = columns[columns.get_level_values(0) == FormOID]
+                    clinical_data = src.REDCap.utils.clinical_data_dataframe(
+                        store.form_records(FormOID), form_columns, checkboxes, store.form_rows(FormOID))
+                    clinical_data = src.REDCap.utils.compact_clinical_data(clinical_data, self.xml, item_types)
+                    span.rows = len(clinical_data)
+                yield form_data(clinical_data, FormOID), instrument_name, repeating
+
+        exports = staged_exports() if store else clinical_data_exports()
+
+        # transform and write each instrument, in parallel if workers > 1
+        # every instrument has its own file, results are collected in instrument order
+        # a zip bundle has a single writer, workers return the tables and they are written here
+        # at most 2 x workers instruments are submitted and not yet collected, with staging only those are in memory
+        if self.workers > 1:
+            write = not src.export.export.bundled()
+
+            def collect(future: concurrent.futures.Future, instrument_name: str) -> None:
+                data, spans = future.result()
+                src.trace.tracer.attach(spans)
+                if not write:
+                    logger.info(f'Writing {instrument_name}.csv')
+                    with src.trace.span('write', instrument=instrument_name) as span:
+                        write_instrument_csv(data, instrument_name, column_types=column_types.get(instrument_name))
+                        span.rows = len(data)
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+                pending = collections.deque()
+                for instrument_data, instrument_name, repeating in exports:
+                    pending.append((executor.submit(export_instrument, instrument_data, instrument_name, repeating, boolean_columns, write,
+                        src.export.export.output_folder, src.trace.Tracer(src.trace.tracer.enabled), column_types.get(instrument_name)),
+                        instrument_name))
+                    if len(pending) >= 2 * self.workers:
+                        collect(*pending.popleft())
+                while pending:
+                    collect(*pending.popleft())
+        else:
+            for instrument_data, instrument_name, repeating in exports:
+                export_instrument(instrument_data, instrument_name, repeating, boolean_columns, column_types=column_types.get(instrument_name))
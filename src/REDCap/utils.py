@@ -1,4 +1,8 @@
 '''get instruments, vars, codelist?'''
+import hashlib
+import re
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
 import pandas as pd
 
 import src.exceptions
@@ -6,56 +10,238 @@ import src.cdisc
 # from exceptions import NoClinicalData
 #from cdisc import Cdisc
 
-def defined_instruments(file: str, namespace: str) -> list:
+def defined_instruments(xml: src.cdisc.Cdisc, namespace: str) -> list:
     '''return list of defined instruments'''
-    return src.cdisc.Cdisc.attribute_values(src.cdisc.Cdisc(file, 'REDCap'), './/odm:FormDef', namespace + 'FormName')
+    return list(xml.form_names)
 
-def study_contains_clinicaldata(file: str) -> None:
+def study_contains_clinicaldata(xml: src.cdisc.Cdisc) -> None:
     '''see if REDCap xml contains clinical data, if not exit'''
-    if not src.cdisc.Cdisc.attribute_value(src.cdisc.Cdisc(file, 'REDCap'), ".//odm:ClinicalData", 'StudyOID'):
+    if not xml.study_oid:
         raise src.exceptions.NoClinicalData
 
-def study_contains_repeating_instrument(file: str, namespace: str) -> bool:
+def study_contains_repeating_instrument(xml: src.cdisc.Cdisc, namespace: str) -> bool:
     '''if study contains repeating instrument(s) return True, if not False'''
-    i = src.cdisc.Cdisc.attribute_values(src.cdisc.Cdisc(file, 'REDCap'), ".//" + namespace + "RepeatingInstrument", namespace + "RepeatInstrument")
-    return (True if i else False)
+    return len(xml.repeating_instruments) > 0
 
-def study_contains_study_event_data(file: str) -> bool:
+def study_contains_study_event_data(xml: src.cdisc.Cdisc) -> bool:
     '''if study contains StudyEventData (repeating instrument(s)) return True, if not False'''
-    i = src.cdisc.Cdisc.attributes(src.cdisc.Cdisc(file, 'REDCap'), ".//odm:StudyEventData")
-    try:
-        if i == None:
-            return False
-    except ValueError:
-        return True
-
-def defined_repeating_instruments(file: str, namespace: str) -> set:
+    return xml.study_event_data
+
+def defined_repeating_instruments(xml: src.cdisc.Cdisc, namespace: str) -> set:
     '''return set of repaiting instrument(s)'''
-    return set(src.cdisc.Cdisc.attribute_values(src.cdisc.Cdisc(file, 'REDCap'), ".//" + namespace + "RepeatingInstrument", namespace + "RepeatInstrument"))
+    return set(xml.repeating_instruments)
 
-def subject_keys(file: str) -> set:
-    '''subject keys defined by REDCap returned as set'''
-    return set(src.cdisc.Cdisc.attribute_values(src.cdisc.Cdisc(file, 'REDCap'), './/odm:SubjectData', 'SubjectKey'))
+def subject_data_pairs(xml: src.cdisc.Cdisc) -> List[Tuple[str, str]]:
+    '''(SubjectKey, FormRepeatKey) pairs that occur in ClinicalData, not every subject with every FormRepeatKey
 
-def form_repeat_keys(file: str) -> set:
-    '''FormRepeatKeys defined by REDCap returned as set'''
-    return set(src.cdisc.Cdisc.attribute_values(src.cdisc.Cdisc(file, 'REDCap'), './/odm:FormData', 'FormRepeatKey'))
+    subjects in the order they are read, the FormRepeatKeys of a subject in numerical order'''
+    order = {SubjectKey: i for i, SubjectKey in enumerate(xml.subject_keys)}
+    def sort_key(pair: Tuple[str, str]) -> tuple:
+        SubjectKey, FormRepeatKey = pair
+        return order[SubjectKey], (0, int(FormRepeatKey), '') if FormRepeatKey.isdigit() else (1, 0, FormRepeatKey)
+    return sorted(xml.subject_form_repeat_keys, key=sort_key)
 
-def subject_data_table_keys(file: str) -> list:
-    '''format keys: SubjectKey_FormRepeatKey and return list'''
-    return [f'{j}_{y}' for i, j in enumerate(subject_keys(file)) for x, y in enumerate(form_repeat_keys(file))]
+def clinical_data_records(items: Iterable[Tuple[str, str, str, str, str]] = ()) -> Dict[str, list]:
+    '''returns clinical data records, one list per field: SubjectKey, FormRepeatKey, FormOID, ItemOID and Value,
+    filled with items (SubjectKey, FormRepeatKey, FormOID, ItemOID, Value) if given'''
+    records = {'SubjectKey': [], 'FormRepeatKey': [], 'FormOID': [], 'ItemOID': [], 'Value': []}
+    SubjectKeys, FormRepeatKeys, FormOIDs, ItemOIDs, Values = records.values()
+    for SubjectKey, FormRepeatKey, FormOID, ItemOID, Value in items:
+        SubjectKeys.append(SubjectKey)
+        FormRepeatKeys.append(FormRepeatKey)
+        FormOIDs.append(FormOID)
+        ItemOIDs.append(ItemOID)
+        Values.append(Value)
+    return records
 
-def subject_data_table_subject_keys(file: str) -> list:
-    '''format subject keys: SubjectKey and return as list
-    
-    Making sure to return the correct number of SubjectKeys'''
-    return [f'{j}' for i, j in enumerate(subject_keys(file)) for x, y in enumerate(form_repeat_keys(file))]
+def checkbox_choices(xml: src.cdisc.Cdisc, namespace: str, codelist: str, items: List[str]) -> List[Tuple[str, str]]:
+    '''returns the (code, label) choices of a checkbox: its CheckboxChoices "1, Apple | 2, Pear" -> [('1', 'Apple'), ('2', 'Pear')],
+    without CheckboxChoices the codes of its items (variable___1 ..)'''
+    choices = xml.index.codelist_defs.get(codelist, {}).get(namespace + 'CheckboxChoices')
+    if choices:
+        return [tuple(c.strip() for c in choice.partition(',')[::2]) for choice in re.split(r'\s*\|\s*', choices.strip())]
+    return [(item.rsplit('___', 1)[1], item.rsplit('___', 1)[1]) for item in items]
 
-def subject_data_table_form_repeat_keys(file: str) -> list:
-    '''format form repeat keys: FormRepeatKey and return as list
-    
-    Making sure to return the correct number of FormRepeatKeys'''
-    return [f'{y}' for i, j in enumerate(subject_keys(file)) for x, y in enumerate(form_repeat_keys(file))]
+def checkbox_items(xml: src.cdisc.Cdisc, namespace: str) -> Dict[str, Tuple[str, str]]:
+    '''returns ItemOID -> (variable, code) of every checkbox item (variable___1 ..), in ItemRef order
+
+    the code is that of the CheckboxChoices at the same position, the ___ suffix if the number of choices differs (metadata cache)'''
+    return xml.metadata('checkbox_items', lambda: query_checkbox_items(xml, namespace))
+
+def query_checkbox_items(xml: src.cdisc.Cdisc, namespace: str) -> Dict[str, Tuple[str, str]]:
+    '''checkbox_items from the index'''
+    variables = {}
+    for item_refs in xml.index.item_group_defs.values():
+        for item in [item['ItemOID'] for item in item_refs]:
+            if xml.index.item_def(item, namespace + 'FieldType') == 'checkbox':
+                variables.setdefault(re.sub(r'___\d+$', '', item), []).append(item)
+
+    items = {}
+    for variable, variable_items in variables.items():
+        choices = checkbox_choices(xml, namespace, xml.index.item_def(variable_items[0], 'CodeListOID'), variable_items)
+        if len(choices) != len(variable_items):
+            choices = [(item.rsplit('___', 1)[1], None) for item in variable_items]
+        for item, (code, _) in zip(variable_items, choices):
+            items[item] = (variable, code)
+    return items
+
+def collapse_checkboxes(data: pd.DataFrame, checkboxes: Dict[str, Tuple[str, str]]) -> pd.DataFrame:
+    '''replace the records of checkbox items (variable___1 .., Value 1/0) by one record per variable whose Value is
+    the comma separated codes that are checked (EMX2 ref_array), empty if none is checked
+
+    per variable one boolean matrix (rows x choices), the codes are joined one choice at a time, not one row at a time.
+    If an item occurs twice for a row the last value is kept'''
+    keys = ['SubjectKey', 'FormRepeatKey', 'FormOID']
+    checkbox = data['ItemOID'].isin(checkboxes.keys())
+    if not checkbox.any():
+        return data
+
+    items = data[checkbox]
+
+    # rows (SubjectKey, FormRepeatKey, FormOID) numbered in the order they are read, their keys by number
+    rows = items.groupby(keys, sort=False).ngroup().to_numpy()
+    _, first = np.unique(rows, return_index=True)
+    row_keys = items[keys].to_numpy()[first]
+
+    # per item its variable and the position of its choice, items in ItemRef order
+    variables = {}
+    position = {}
+    for item, (variable, code) in checkboxes.items():
+        position[item] = len(variables.setdefault(variable, []))
+        variables[variable].append(code)
+    variable_names = list(variables)
+    variable_number = {variable: number for number, variable in enumerate(variable_names)}
+    item_index, item_names = pd.factorize(items['ItemOID'])
+    item_variable = np.array([variable_number[checkboxes[item][0]] for item in item_names])[item_index]
+    item_position = np.array([position[item] for item in item_names])[item_index]
+    checked = items['Value'].to_numpy() == '1'
+
+    # the records of one variable are a contiguous slice after a stable sort on variable
+    order = np.argsort(item_variable, kind='stable')
+    bounds = np.flatnonzero(np.diff(item_variable[order])) + 1
+    collapsed = []
+    for part in np.split(order, bounds):
+        variable = variable_names[item_variable[part[0]]]
+        codes = variables[variable]
+        # rows x choices, a row only gets a value if an item of this variable was read for it
+        present, row = np.unique(rows[part], return_inverse=True)
+        matrix = np.zeros((len(present), len(codes)), dtype=bool)
+        matrix[row, item_position[part]] = checked[part]
+        joined = np.full(len(present), '', dtype=object)
+        for j, code in enumerate(codes):
+            joined = joined + np.where(matrix[:, j], code + ',', '')
+        value = pd.Series(joined).str[:-1]
+        collapsed.append(pd.DataFrame(row_keys[present], columns=keys).assign(ItemOID=variable, Value=value.where(value != '')))
+
+    return pd.concat([data[~checkbox]] + collapsed, ignore_index=True)[data.columns]
+
+def clinical_data_dataframe(records: Dict[str, list], columns: pd.MultiIndex, checkboxes: Dict[str, Tuple[str, str]] = None,
+        rows: pd.MultiIndex = None) -> pd.DataFrame:
+    '''build the clinical data MultiIndex DataFrame from records in one go
+
+    rows (SubjectKey, FormRepeatKey) keep the order in which they were read (or are the given rows), columns follow the given
+    (FormOID, ItemOID) MultiIndex. Items that are not a column are dropped, if an item occurs twice the last value is kept.
+    checkbox items (checkbox_items) are collapsed into one ref_array value per variable'''
+    keys = ['SubjectKey', 'FormRepeatKey']
+    data = pd.DataFrame(records, columns=list(clinical_data_records()))
+    index = rows if rows is not None else pd.MultiIndex.from_frame(data[keys].drop_duplicates())
+    # only pivot the forms that are asked for, the rows stay those of all forms
+    data = data[data['FormOID'].isin(columns.get_level_values(0))]
+    if data.empty:
+        return pd.DataFrame([], index=index, columns=columns)
+
+    if checkboxes:
+        data = collapse_checkboxes(data, checkboxes)
+    data = data.drop_duplicates(subset=keys + ['FormOID', 'ItemOID'], keep='last')
+    data = data.pivot(index=keys, columns=['FormOID', 'ItemOID'], values='Value')
+    # columns without any value would otherwise become float, keep every column object like the values
+    return data.reindex(index=index, columns=columns).astype(object)
+
+def compact_clinical_data(dataframe: pd.DataFrame, xml: src.cdisc.Cdisc, column_types: Dict[str, str]) -> pd.DataFrame:
+    '''store coded items (ItemDef with a CodeListRef) as Categorical, categories are the CodeList values (and values outside
+    the CodeList), int and decimal items (EMX2 columnType) as Int64 and float64 if they write the same csv, other items stay object
+
+    column_types: ItemOID -> columnType'''
+    def categorical(values: pd.Series, codelist: str) -> pd.Categorical:
+        categories = dict.fromkeys(i['CodedValue'] for i in xml.index.codelists.get(codelist, []))
+        categories.update(dict.fromkeys(sorted(set(values.dropna()) - categories.keys())))
+        return pd.Categorical(values, categories=list(categories))
+
+    def numeric(values: pd.Series, columnType: str) -> pd.Series:
+        '''numbers if every value is written back unchanged (no leading zeros, 70 not 70.0), else the values'''
+        present = values.notna()
+        numbers = pd.to_numeric(values, errors='coerce')
+        if columnType == 'int':
+            if not (numbers[present] % 1 == 0).all():
+                return values
+            numbers = numbers.astype('Int64')
+        if (numbers[present].astype(str) == values[present]).all():
+            return numbers
+        return values
+
+    columns = []
+    for position, (FormOID, ItemOID) in enumerate(dataframe.columns):
+        values = dataframe.iloc[:, position]
+        codelist = xml.index.item_def(ItemOID, 'CodeListOID')
+        if codelist is not None:
+            values = categorical(values, codelist)
+        elif column_types.get(ItemOID) in ('int', 'decimal'):
+            values = numeric(values, column_types[ItemOID])
+        columns.append(values)
+
+    # build the frame once, columns can repeat (collapsed checkboxes)
+    result = pd.DataFrame(dict(enumerate(columns)), index=dataframe.index)
+    result.columns = dataframe.columns
+    return result
+
+def clinical_data_digests(items: Iterable[Tuple[str, str, str, str, str]]) -> Dict[str, str]:
+    '''returns FormOID -> sha256 of the clinical data its instrument table is built from: the items of that form
+    (SubjectKey, FormRepeatKey, ItemOID, Value) in the order they were read, then its rows (SubjectKey, FormRepeatKey)
+    in the order they were first read in the whole file, the order of the table rows
+
+    items of other forms (a new subject with data in one form only) leave the digest of a form unchanged'''
+    rows = {}
+    forms = {}
+    for SubjectKey, FormRepeatKey, FormOID, ItemOID, Value in items:
+        row = rows.setdefault((SubjectKey, FormRepeatKey), len(rows))
+        if FormOID not in forms:
+            forms[FormOID] = (hashlib.sha256(), set())
+        sha, form_rows = forms[FormOID]
+        sha.update(f'{SubjectKey}\x1f{FormRepeatKey}\x1f{ItemOID}\x1f{Value}\x1e'.encode('utf-8'))
+        form_rows.add(row)
+
+    keys = list(rows)
+    digests = {}
+    for FormOID, (sha, form_rows) in forms.items():
+        for row in sorted(form_rows):
+            sha.update('{}\x1f{}\x1d'.format(*keys[row]).encode('utf-8'))
+        digests[FormOID] = sha.hexdigest()
+    return digests
+
+def boolean_columns(dataframe: pd.DataFrame) -> set:
+    '''returns the columnName(s) of the datamodel that are REDCap booleans stored as 0/1 (yesno, truefalse)'''
+    boolean = (dataframe['DataType'] == 'boolean') & (dataframe['FieldType'].isin(['yesno', 'truefalse']))
+    return set(dataframe.loc[boolean, 'columnName'])
+
+# REDCap booleans (yesno, truefalse) as written to the instrument tables
+boolean_values = {'0': 'FALSE', '1': 'TRUE'}
+
+def ref_table_name(tableName: str, columnName: str, FieldType: str) -> str:
+    '''returns the table a yesno, truefalse (one shared table each) or checkbox (one per variable: instrument_variable) column refers to,
+    None for other columns'''
+    if FieldType in ('yesno', 'truefalse'):
+        return FieldType
+    if FieldType == 'checkbox':
+        return f'{tableName}_{columnName}'
+    return None
+
+def column_types(dataframe: pd.DataFrame) -> Dict[str, Dict[str, str]]:
+    '''returns per tableName the EMX2 columnType of its columns (columnName -> columnType) from the datamodel'''
+    columns = dataframe.dropna(subset=['columnName', 'columnType'])
+    types = {}
+    for tableName, columnName, columnType in columns[['tableName', 'columnName', 'columnType']].itertuples(index=False, name=None):
+        types.setdefault(tableName, {}).setdefault(columnName, columnType)
+    return types
 
 def datamodel_table_columns() -> pd.DataFrame:
     '''returns (empty) datamodel aka molgenis.csv table with column names
@@ -68,4 +254,10 @@ def datamodel_table_columns() -> pd.DataFrame:
             'refTable', 'key', 'required', 'validation',
             'DataType', 'FieldType', 'TextValidationType']
     )
-    return result
\ No newline at end of file
+    return result
+
+def datamodel_table(records: List[Dict[str, str]]) -> pd.DataFrame:
+    '''returns datamodel aka molgenis.csv table built in one go from a list of row records
+
+    fields missing from a record are left empty, all columns are object like datamodel_table_columns()'''
+    return pd.DataFrame(records, columns=datamodel_table_columns().columns, dtype=object)
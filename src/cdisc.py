@@ -1,18 +1,316 @@
+import configparser
+import logging
+import os
 import re
 import xml.etree.ElementTree as ET
 import pandas as pd
-import sys
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple, Union
+
+import src.emx2
+import src.exceptions
+import src.metadata_cache
+import src.trace
+
+logger = logging.getLogger(__name__)
+
+class MetaDataIndex:
+    '''One pass index over the MetaDataVersion, OID lookups without XPath
+
+    form_defs: FormDef OID -> attributes
+    item_group_defs: ItemGroupDef OID -> list of ItemRef attributes
+    item_defs: ItemDef OID -> attributes (and CodeListOID if the item has a CodeListRef)
+    codelists: CodeList OID -> list of CodeListItem CodedValue and Decode
+    codelist_defs: CodeList OID -> attributes
+
+    with forms (FormName or FormOID) only those FormDefs and the ItemGroupDefs they refer to are kept'''
+
+    def __init__(self, root: ET.Element, namespaces: Dict[str, str], forms: Set[str] = None) -> None:
+        self.form_defs: Dict[str, Dict[str, str]] = {}
+        item_group_refs: Dict[str, List[str]] = {}
+        self.item_group_defs: Dict[str, List[Dict[str, str]]] = {}
+        self.item_defs: Dict[str, Dict[str, str]] = {}
+        self.codelists: Dict[str, List[Dict[str, str]]] = {}
+        self.codelist_defs: Dict[str, Dict[str, str]] = {}
+
+        odm = '{' + namespaces['odm'] + '}'
+        for metadata in root.iterfind('.//odm:MetaDataVersion', namespaces):
+            for elem in metadata:
+                if elem.tag == odm + 'FormDef':
+                    self.form_defs[elem.get('OID')] = dict(elem.attrib)
+                    item_group_refs[elem.get('OID')] = [i.get('ItemGroupOID') for i in elem.iterfind('odm:ItemGroupRef', namespaces)]
+                elif elem.tag == odm + 'ItemGroupDef':
+                    self.item_group_defs[elem.get('OID')] = [dict(i.attrib) for i in elem.iterfind('odm:ItemRef', namespaces)]
+                elif elem.tag == odm + 'ItemDef':
+                    attributes = dict(elem.attrib)
+                    codelist = elem.find('odm:CodeListRef', namespaces)
+                    if codelist is not None:
+                        attributes['CodeListOID'] = codelist.get('CodeListOID')
+                    self.item_defs[elem.get('OID')] = attributes
+                elif elem.tag == odm + 'CodeList':
+                    self.codelist_defs[elem.get('OID')] = dict(elem.attrib)
+                    self.codelists[elem.get('OID')] = [{
+                        'CodedValue': i.get('CodedValue'),
+                        'Decode': i.findtext('odm:Decode/odm:TranslatedText', default='', namespaces=namespaces)
+                    } for i in elem.iterfind('odm:CodeListItem', namespaces)]
+
+        if forms is not None:
+            redcap = '{' + namespaces['redcap'] + '}'
+            self.form_defs = {oid: form for oid, form in self.form_defs.items() if oid in forms or form.get(redcap + 'FormName') in forms}
+            unknown = set(forms) - set(self.form_defs) - {form.get(redcap + 'FormName') for form in self.form_defs.values()}
+            if unknown:
+                raise src.exceptions.NoForm(sorted(unknown))
+            item_groups = {oid for form in self.form_defs for oid in item_group_refs[form]}
+            self.item_group_defs = {oid: items for oid, items in self.item_group_defs.items() if oid in item_groups}
+
+    def item_def(self, oid: str, name: str) -> str:
+        '''return attribute name of ItemDef oid, None if the ItemDef or attribute does not exists (or is empty)'''
+        return self.item_defs.get(oid, {}).get(name) or None
+
+
+class ElementTreeParser:
+    '''Python standard library xml.etree.ElementTree (default)'''
+    errors = (ET.ParseError,)
+
+    def parse(self, file: str) -> ET.Element:
+        return ET.parse(file).getroot()
+
+    def iterparse(self, file: str, events: Tuple[str, ...]) -> Iterator[Tuple[str, ET.Element]]:
+        return ET.iterparse(file, events=events)
+
+    def findall(self, root: ET.Element, xpath: str, namespaces: Dict[str, str]) -> List[ET.Element]:
+        return root.findall(xpath, namespaces)
+
+
+class LxmlParser:
+    '''lxml (libxml2), optional: pip install lxml
+
+    huge_tree lifts the libxml2 limits for very large exports, XPath expressions are compiled once'''
+    def __init__(self) -> None:
+        try:
+            from lxml import etree
+        except ImportError:
+            raise src.exceptions.NoParser('lxml')
+        self.etree = etree
+        self.errors = (etree.ParseError,)
+        self.xpaths = {}
+
+    def parse(self, file: str) -> ET.Element:
+        parser = self.etree.XMLParser(huge_tree=True, remove_comments=True, remove_pis=True)
+        return self.etree.parse(str(file), parser).getroot()
+
+    def iterparse(self, file: str, events: Tuple[str, ...]) -> Iterator[Tuple[str, ET.Element]]:
+        return self.etree.iterparse(str(file), events=events, huge_tree=True, remove_comments=True, remove_pis=True)
+
+    def findall(self, root: ET.Element, xpath: str, namespaces: Dict[str, str]) -> List[ET.Element]:
+        if xpath not in self.xpaths:
+            # {uri}name (ElementTree) to prefix:name (XPath)
+            expression = xpath
+            for prefix, uri in namespaces.items():
+                expression = expression.replace('{' + uri + '}', prefix + ':')
+            self.xpaths[xpath] = self.etree.XPath(expression, namespaces=namespaces)
+        return self.xpaths[xpath](root)
+
+
+# parser backends by name, select one with parser= or parser in src/config.ini
+PARSERS = {
+    'etree': ElementTreeParser,
+    'lxml': LxmlParser
+}
+
+
+# magic bytes of files that are uploaded instead of the xml export: zip (docx, xlsx), gzip, pdf, ole2 (doc, xls)
+BINARY_SIGNATURES = (b'PK\x03\x04', b'\x1f\x8b', b'%PDF', b'\xd0\xcf\x11\xe0')
+
+def preflight(file: str, chunk_size: int = 65536) -> str:
+    '''check that file is a CDISC ODM export with ClinicalData without parsing all of it, returns the ODM namespace
+
+    reads the first bytes (binary formats), the root element (ODM and its namespace) and stops at the first
+    ClinicalData start tag, raises NoFile, InvalidXml, NoNamespace or NoClinicalData'''
+    try:
+        f = open(file, 'rb')
+    except OSError:
+        raise src.exceptions.NoFile()
+    with f:
+        chunk = f.read(chunk_size)
+        if not chunk.strip() or chunk.startswith(BINARY_SIGNATURES):
+            raise src.exceptions.InvalidXml()
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        namespace = None
+        try:
+            while chunk:
+                parser.feed(chunk)
+                for event, elem in parser.read_events():
+                    if event == 'end':
+                        # metadata is only read, not kept
+                        elem.clear()
+                    elif namespace is None:
+                        match = re.match(r'\{(.+)\}(.+)', elem.tag)
+                        if not match:
+                            raise src.exceptions.NoNamespace()
+                        if match.group(2) != 'ODM':
+                            raise src.exceptions.InvalidXml()
+                        namespace = match.group(1)
+                    elif elem.tag == '{' + namespace + '}ClinicalData':
+                        if not elem.get('StudyOID'):
+                            raise src.exceptions.NoClinicalData()
+                        return namespace
+                chunk = f.read(chunk_size)
+            parser.close()
+        except ET.ParseError:
+            raise src.exceptions.InvalidXml()
+    raise src.exceptions.NoClinicalData()
+
 
 class Cdisc:
+    parse_count: int = 0
+    config = configparser.ConfigParser()
+    config.read('./src/config.ini')
     
-    def __init__(self, file: str, edc: str='REDCap') -> None:
+    def __init__(self, file: str, edc: str='REDCap', stream: bool = False, parser: str = None,
+            forms: Iterable[str] = None, subjects: Union[Iterable[str], Callable[[str], bool]] = None, metadata_cache: str = None) -> None:
+        '''forms (FormName or FormOID) and subjects (SubjectKeys or a SubjectKey predicate) select part of the study,
+        other FormDefs are left out of the metadata index and other FormData and SubjectData are dropped as they are read
+
+        metadata_cache (default metadata_cache in src/config.ini) is the folder where results derived from the
+        MetaDataVersion are kept for later runs on the same data dictionary, not set: no cache'''
         self.file = file
         self.edc = edc
-        self.read_parse_xml()
-        self.namespace()
+        self.stream = stream
+        self.metadata_cache = metadata_cache if metadata_cache is not None else Cdisc.config['settings'].get('metadata_cache', '')
+        self.forms = set(forms) if forms is not None else None
+        if subjects is None or callable(subjects):
+            self.subject_filter = subjects
+        else:
+            self.subject_filter = set(subjects).__contains__
+        parser = parser or Cdisc.config['settings'].get('parser', 'etree')
+        if parser not in PARSERS:
+            raise src.exceptions.NoParser(parser)
+        self.parser = PARSERS[parser]()
+        self.load()
+
+    def load(self) -> None:
+        '''parse the file (up to ClinicalData in streaming mode), everything derived from an earlier parse is dropped'''
+        # taken before parsing, a change while the file is read is found by the next refresh()
+        self._source = self.source()
+        if self.stream:
+            self.read_parse_metadata()
+        else:
+            self.read_parse_xml()
+        # the method, after the first parse the instance attribute namespace holds its result
+        Cdisc.namespace(self)
         #self.namespaces = {'odm': self.namespace}
         self.namespaces = {'odm': self.namespace, 'redcap': 'https://projectredcap.org'}
+        self._index = None
+        self._subjects = None
+        self._cache: Dict[str, object] = {}
+        if self.forms is not None:
+            # unknown forms fail here, before anything is written
+            self.index
+
+    def refresh(self) -> bool:
+        '''parse the file again if it changed (modification time, size) since it was read, True if it did
+
+        called once at the start of every stage, cached results are not checked against the file on every use'''
+        if self.source() == self._source:
+            return False
+        logger.info(f'{self.file} changed, parsing it again')
+        self.load()
+        return True
+
+    @property
+    def index(self) -> MetaDataIndex:
+        '''MetaDataVersion index, build on first use'''
+        if self._index is None:
+            with src.trace.span('index') as span:
+                self._index = self.metadata('index', lambda: MetaDataIndex(self.root, self.namespaces, self.forms))
+                span.rows = len(self._index.item_defs)
+        return self._index
     
+    def source(self) -> Tuple[int, int]:
+        '''modification time and size of the file, None if it can not be read'''
+        try:
+            stat = os.stat(self.file)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def cached(self, name: str, query: Callable[[], object]) -> object:
+        '''result of query, computed on first use and kept until refresh() finds that the file changed'''
+        if name not in self._cache:
+            self._cache[name] = query()
+        return self._cache[name]
+
+    def metadata(self, name: str, query: Callable[[], object]) -> object:
+        '''result of query on the MetaDataVersion, from the metadata cache (if set) or computed and stored there,
+        kept in memory until refresh() finds that the file changed. The result is shared, do not change it'''
+        def store() -> src.metadata_cache.MetadataCache:
+            # the results also depend on src/config.ini (subject table name, [redcap.datatype] rules ..), a changed setting gets a new cache
+            config = [(section, sorted(src.emx2.Emx2.config[section].items())) for section in src.emx2.Emx2.config.sections()]
+            forms = sorted(self.forms) if self.forms is not None else None
+            return src.metadata_cache.metadata_cache(self.metadata_cache, self.file, self.edc, forms, config)
+
+        def query_store() -> object:
+            cache = self.cached('metadata_cache', store)
+            return cache.get(name, query) if cache else query()
+        return self.cached('metadata.' + name, query_store)
+
+    @property
+    def study_oid(self) -> str:
+        '''StudyOID of ClinicalData, None if the file has no ClinicalData'''
+        return self.cached('study_oid', lambda: self.attribute_value('.//odm:ClinicalData', 'StudyOID'))
+
+    @property
+    def form_names(self) -> List[str]:
+        '''REDCap FormName of every FormDef, in order'''
+        redcap = '{' + self.namespaces['redcap'] + '}'
+        return self.cached('form_names', lambda: [form.get(redcap + 'FormName') for form in self.index.form_defs.values()])
+
+    @property
+    def repeating_instruments(self) -> Tuple[str, ...]:
+        '''REDCap RepeatInstrument of every RepeatingInstrument, empty if the study has none'''
+        redcap = '{' + self.namespaces['redcap'] + '}'
+        def query() -> Tuple[str, ...]:
+            values = self.attribute_values('.//' + redcap + 'RepeatingInstrument', redcap + 'RepeatInstrument')
+            return tuple(values) if values is not False else ()
+        return self.cached('repeating_instruments', query)
+
+    def clinical_data_keys(self) -> Dict[str, object]:
+        '''SubjectKeys and the (SubjectKey, FormRepeatKey) pairs that have FormData (in the order they are read)
+        and whether there is StudyEventData, in one pass over ClinicalData'''
+        def query() -> Dict[str, object]:
+            subject_keys = {}
+            pairs = {}
+            study_event_data = False
+            for SubjectData in self.iter_subject_data():
+                SubjectKey = SubjectData.get('SubjectKey')
+                subject_keys[SubjectKey] = None
+                for FormData in SubjectData.iterfind('.//odm:FormData', self.namespaces):
+                    if self.form_selected(FormData):
+                        pairs[(SubjectKey, FormData.get('FormRepeatKey'))] = None
+                if not study_event_data:
+                    study_event_data = SubjectData.find('odm:StudyEventData', self.namespaces) is not None
+            return {
+                'subject_keys': tuple(subject_keys),
+                'subject_form_repeat_keys': tuple(pairs),
+                'study_event_data': study_event_data
+            }
+        return self.cached('clinical_data_keys', query)
+
+    @property
+    def subject_keys(self) -> Tuple[str, ...]:
+        '''SubjectKeys in the order they are read'''
+        return self.clinical_data_keys()['subject_keys']
+
+    @property
+    def subject_form_repeat_keys(self) -> Tuple[Tuple[str, str], ...]:
+        '''(SubjectKey, FormRepeatKey) pairs that occur in ClinicalData, in the order they are read'''
+        return self.clinical_data_keys()['subject_form_repeat_keys']
+
+    @property
+    def study_event_data(self) -> bool:
+        '''True if ClinicalData has StudyEventData (repeating instruments)'''
+        return self.clinical_data_keys()['study_event_data']
+
     def read_parse_xml(self) -> ET.ElementTree:
         '''Read and parse xml'''
         try:
@@ -20,11 +318,114 @@ class Cdisc:
             # TODO check if register_namespace does anything
             ET.register_namespace("redcap", "https://projectredcap.org")
             #print(f'Parsing file: {self.file}')
-            self.root = ET.parse(self.file).getroot()
-        except FileNotFoundError:
-            sys.exit('File not found, please give correct file path.')
-        except ET.ParseError:
-            sys.exit('ParseError, please provide valid xml file.')
+            self.root = self.parser.parse(self.file)
+            Cdisc.parse_count += 1
+        except OSError: # FileNotFoundError, lxml raises OSError
+            raise src.exceptions.NoFile()
+        except self.parser.errors:
+            raise src.exceptions.InvalidXml()
+
+    def read_parse_metadata(self) -> None:
+        '''Read and parse xml up to the start of ClinicalData (streaming mode)
+
+        The root only holds the Study (GlobalVariables, MetaDataVersion) and an
+        empty ClinicalData element, SubjectData is read by iter_subject_data()'''
+        try:
+            ET.register_namespace("redcap", "https://projectredcap.org")
+            root = None
+            for event, elem in self.parser.iterparse(self.file, ('start', 'end')):
+                if root is None:
+                    root = elem
+                if event == 'start' and elem.tag.endswith('}ClinicalData'):
+                    # keep the attributes (StudyOID), drop whatever the parser already read ahead
+                    attrib = dict(elem.attrib)
+                    elem.clear()
+                    elem.attrib.update(attrib)
+                    break
+            self.root = root
+            Cdisc.parse_count += 1
+        except OSError: # FileNotFoundError, lxml raises OSError
+            raise src.exceptions.NoFile()
+        except self.parser.errors:
+            raise src.exceptions.InvalidXml()
+
+    def form_selected(self, FormData: ET.Element) -> bool:
+        '''True if the form of FormData is selected, always True without forms'''
+        return self.forms is None or FormData.get('FormOID') in self.index.form_defs
+
+    def iter_subject_data(self) -> Iterator[ET.Element]:
+        '''Yield SubjectData elements one at a time
+
+        In streaming mode the file is read with iterparse and every SubjectData
+        is cleared once it has been processed, so memory is bound by the largest subject.
+        Subjects that are not selected are skipped. In streaming mode FormData of a subject or form that is not selected
+        is dropped while it is read, from its start tag on. Otherwise the parsed document is left as it is and callers
+        skip those FormData (form_selected)'''
+        def selected(SubjectData: ET.Element) -> bool:
+            return self.subject_filter is None or self.subject_filter(SubjectData.get('SubjectKey'))
+
+        if not self.stream:
+            for SubjectData in self.root.iterfind('.//odm:SubjectData', self.namespaces):
+                if selected(SubjectData):
+                    yield SubjectData
+            return
+
+        subject_data = '{' + self.namespace + '}SubjectData'
+        form_data = '{' + self.namespace + '}FormData'
+        try:
+            Cdisc.parse_count += 1
+            # the open elements, parents[-1] is the parent of the element that ends
+            parents = []
+            # FormData of a subject or form that is not selected, each of its children is removed as soon as it is read
+            skipped = None
+            skip = False
+            for event, elem in self.parser.iterparse(self.file, ('start', 'end')):
+                if event == 'start':
+                    if skipped is None:
+                        if elem.tag == subject_data:
+                            skip = not selected(elem)
+                        elif elem.tag == form_data and (skip or not self.form_selected(elem)):
+                            skipped = elem
+                    parents.append(elem)
+                    continue
+                parents.pop()
+                if skipped is not None:
+                    if elem is skipped:
+                        skipped = None
+                        parents[-1].remove(elem)
+                    elif parents[-1] is skipped:
+                        skipped.remove(elem)
+                elif elem.tag == subject_data:
+                    if not skip:
+                        yield elem
+                    elem.clear()
+                    if parents:
+                        parents[-1].remove(elem)
+                elif elem.tag.endswith('}MetaDataVersion'):
+                    # metadata is already available through self.root
+                    elem.clear()
+        except self.parser.errors:
+            raise src.exceptions.InvalidXml()
+
+    @property
+    def subjects(self) -> Dict[str, List[ET.Element]]:
+        '''SubjectKey -> SubjectData element(s), grouped in one pass over ClinicalData (not in streaming mode)'''
+        if self._subjects is None:
+            self._subjects = {}
+            for SubjectData in self.iter_subject_data():
+                self._subjects.setdefault(SubjectData.get('SubjectKey'), []).append(SubjectData)
+        return self._subjects
+
+    def iter_subjects(self) -> Iterator[Tuple[str, List[ET.Element]]]:
+        '''Yield SubjectKey and its SubjectData element(s)
+
+        In streaming mode every SubjectData is yielded on its own as soon as it is read,
+        it is cleared when the next one is requested'''
+        if not self.stream:
+            yield from self.subjects.items()
+            return
+        for SubjectData in self.iter_subject_data():
+            yield SubjectData.get('SubjectKey'), [SubjectData]
 
     def namespace(self) -> str:
         '''Return the namespace uri for the current file'''
@@ -32,14 +433,14 @@ class Cdisc:
         try:
             self.namespace = re.compile(r'\{(.+)\}').match(self.root.tag).group(1)
         except:
-            sys.exit('Failed to retrieve namespace.')
+            raise src.exceptions.NoNamespace()
     
     def attributes(self, xpath: str) -> pd.DataFrame:
         '''Returns Pandas DataFrame of found attributes'''
-        columns = self.root.find(xpath, self.namespaces)
-        if columns is not None:
+        elements = self.findall(xpath)
+        if elements:
             return pd.DataFrame(
-                [i.attrib for i in self.root.findall(xpath, self.namespaces)], columns=list(columns.attrib))
+                [dict(i.attrib) for i in elements], columns=list(elements[0].attrib))
         return None
 
     def attribute_values(self, element: str, name: str) -> pd.DataFrame:
@@ -53,9 +454,9 @@ class Cdisc:
 
     def attribute(self, xpath: str) -> pd.DataFrame:
         '''Returns Pandas DataFrame of found attribute'''
-        columns = self.root.find(xpath, self.namespaces)
-        if columns is not None:
-            return pd.DataFrame([self.root.find(xpath, self.namespaces).attrib], columns=list(columns.attrib))
+        elements = self.findall(xpath)
+        if elements:
+            return pd.DataFrame([dict(elements[0].attrib)], columns=list(elements[0].attrib))
         else:
             return None
 
@@ -65,32 +466,10 @@ class Cdisc:
             return value[0]
         return None
 
+    def findall(self, xpath: str) -> List[ET.Element]:
+        '''return all elements matching xpath, evaluated by the parser backend'''
+        return self.parser.findall(self.root, xpath, self.namespaces)
+
     def iterfind(self, xpath: str) -> ET.ElementTree:
         '''return tree'''
         return self.root.iterfind(xpath, self.namespaces)
-    
-    def element_text(self, xpath: str) -> pd.DataFrame:
-        '''pass element and return text'''
-        # attributes = self.attributes(element)
-        # try:
-        #     values = attributes[name].values
-        # except:
-        #     values = False
-        # return values
-        #columns = self.root.find(xpath, self.namespaces)
-        #if columns is not None:
-        for i in self.root.findall(xpath, self.namespaces):
-            try:
-                #text = i.find('Question').text
-                #OID = i.get('OID')
-                #print(OID)
-                #print(i.find('Question/TranslatedText'))
-                #print("".join(i.itertext()))
-                #return text
-                print(i.tag, i.text)
-                #rint(text)
-            except:
-                pass
-            #return pd.DataFrame(
-            #    [i.text for i in self.root.findall(xpath, self.namespaces)], columns=list(columns.attrib))
-        #return None
\ No newline at end of file
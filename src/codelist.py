@@ -1,18 +1,24 @@
 '''codelists'''
 from abc import ABC, abstractmethod
+import logging
 
+import src.cdisc
 import src.exceptions
+import src.manifest
 import src.REDCap.codelist
 import src.REDCap.utils
 # from exceptions import NoValidEdc
 # from REDCap.codelist import REDCapCodelist
 # from REDCap.utils import study_contains_clinicaldata
 
+logger = logging.getLogger(__name__)
+
 class Codelist(ABC):
 
-    def __init__(self, edc: str, file: str) -> None:
+    def __init__(self, edc: str, xml: src.cdisc.Cdisc, manifest: src.manifest.Manifest = None) -> None:
         self.edc = edc
-        self.file = file
+        self.xml = xml
+        self.manifest = manifest
         super().__init__()
 
     @abstractmethod
@@ -22,9 +28,9 @@ class Codelist(ABC):
 class Variables(Codelist):
 
     def execute(self) -> None:
-        print(f"Variables, EDC: {self.edc}, file: {self.file}")
+        logger.info(f"Variables, EDC: {self.edc}, file: {self.xml.file}")
         if self.edc == 'REDCap':
-            src.REDCap.codelist.REDCapCodelist(self.file).codelist_data_table()
+            pass
         elif self.edc == 'Castor':
             pass
         else:
@@ -33,16 +39,16 @@ class Variables(Codelist):
 class VariableValues(Codelist):
 
     def execute(self) -> None:
-        print(f"RepeatedVariables, EDC: {self.edc}, file: {self.file}")
+        logger.info(f"VariableValues, EDC: {self.edc}, file: {self.xml.file}")
         if self.edc == 'REDCap':
-            pass
+            src.REDCap.codelist.REDCapCodelist(self.xml, self.manifest).codelist_data_table()
         elif self.edc == 'Castor':
             pass
         else:
             raise src.exceptions.NoValidEdc
 
-def codelists(edc, file) -> None:
-    src.REDCap.utils.study_contains_clinicaldata(file)
+def codelists(edc: str, xml: src.cdisc.Cdisc, manifest: src.manifest.Manifest = None) -> None:
+    src.REDCap.utils.study_contains_clinicaldata(xml)
 
-    Variables(edc, file).execute()
-    VariableValues(edc, file).execute()
\ No newline at end of file
+    Variables(edc, xml).execute()
+    VariableValues(edc, xml, manifest).execute()
\ No newline at end of file
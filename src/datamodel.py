@@ -1,30 +1,37 @@
 '''aka molgenis.csv'''
 from abc import ABC, abstractmethod
+import logging
+import pandas as pd
 
+import src.cdisc
 import src.exceptions
+import src.manifest
+import src.REDCap.codelist
 import src.REDCap.datamodel
 import src.REDCap.utils
 #from exceptions import NoValidEdc
 #from REDCap.datamodel import REDCapDatamodel
 #from REDCap.utils import study_contains_clinicaldata
 
+logger = logging.getLogger(__name__)
+
 class Molgenis(ABC):
 
-    def __init__(self, edc: str, file: str) -> None:
+    def __init__(self, edc: str, xml: src.cdisc.Cdisc) -> None:
         self.edc = edc
-        self.file = file
+        self.xml = xml
         super().__init__()
 
     @abstractmethod
-    def execute(self) -> None:
+    def execute(self) -> pd.DataFrame:
         pass
 
 class SubjectData(Molgenis):
 
-    def execute(self) -> None:
-        print(f"Subjects, EDC: {self.edc}, file: {self.file}")
+    def execute(self) -> pd.DataFrame:
+        logger.info(f"Subjects, EDC: {self.edc}, file: {self.xml.file}")
         if self.edc == 'REDCap':
-            src.REDCap.datamodel.REDCapDatamodel(self.file).subject_data()
+            return src.REDCap.datamodel.REDCapDatamodel(self.xml).subject_data()
         elif self.edc == 'Castor':
             pass
         else:
@@ -32,17 +39,30 @@ class SubjectData(Molgenis):
 
 class Instruments(Molgenis):
 
-    def execute(self) -> None:
-        print(f"Intruments, EDC: {self.edc}, file: {self.file}")
+    def execute(self) -> pd.DataFrame:
+        logger.info(f"Intruments, EDC: {self.edc}, file: {self.xml.file}")
+        if self.edc == 'REDCap':
+            return src.REDCap.datamodel.REDCapDatamodel(self.xml).instruments()
+        elif self.edc == 'Castor':
+            pass
+        else:
+            raise src.exceptions.NoValidEdc
+
+class Codelists(Molgenis):
+
+    def execute(self) -> pd.DataFrame:
+        logger.info(f"Codelists, EDC: {self.edc}, file: {self.xml.file}")
         if self.edc == 'REDCap':
-            src.REDCap.datamodel.REDCapDatamodel(self.file).instruments()
+            return src.REDCap.codelist.REDCapCodelist(self.xml).datamodel()
         elif self.edc == 'Castor':
             pass
         else:
             raise src.exceptions.NoValidEdc
 
-def datamodel(edc, file) -> None:
-    src.REDCap.utils.study_contains_clinicaldata(file)
+def datamodel(edc: str, xml: src.cdisc.Cdisc, manifest: src.manifest.Manifest = None) -> None:
+    src.REDCap.utils.study_contains_clinicaldata(xml)
 
-    SubjectData(edc, file).execute()
-    Instruments(edc, file).execute()
\ No newline at end of file
+    # molgenis.csv is written once, after all its tables are collected
+    tables = [SubjectData(edc, xml).execute(), Instruments(edc, xml).execute(), Codelists(edc, xml).execute()]
+    if edc == 'REDCap':
+        src.REDCap.datamodel.REDCapDatamodel(xml).write_datamodel(tables, manifest)
\ No newline at end of file
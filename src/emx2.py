@@ -1,48 +1,78 @@
 '''convert to emx2 datatypes'''
+import configparser
+import logging
+from typing import Dict, Tuple
 import pandas as pd
 
+import src.exceptions
+
+logger = logging.getLogger(__name__)
+
 class Emx2:
+    config = configparser.ConfigParser()
+    config.optionxform = str # REDCap types are case sensitive (partialDatetime)
+    config.read('./src/config.ini')
+
+    def datatype_list() -> Dict[Tuple[str, str, str], str]:
+        '''Defines the columnType for EMX to convert to and return a dictionary keyed on (DataType, FieldType, TextValidationType)
+
+        TextValidationType '*' matches any (or no) validation type, an exact TextValidationType takes precedence.
+        Rules in the [redcap.datatype] section of config.ini (DataType,FieldType,TextValidationType = columnType)
+        are added to, or replace, the rules below, a rule that is not in that form raises InvalidDatatype'''
+        dict = {
+            ('text', 'text', 'email'): 'text',
+            ('date', 'text', '*'): 'date',
+            ('partialDatetime', 'text', '*'): 'datetime',
+            ('datetime', 'text', '*'): 'datetime',
+            ('text', 'text', '*'): 'text',
+            ('integer', 'text', '*'): 'int',
+            ('float', 'text', '*'): 'decimal',
+            ('partialTime', 'text', '*'): 'string',
+            ('text', 'textarea', '*'): 'text',
+            ('float', 'calc', '*'): 'decimal',
+            ('text', 'select', '*'): 'text',
+            ('text', 'radio', '*'): 'text',
+            ('boolean', 'checkbox', '*'): 'ref_array',
+            ('boolean', 'yesno', '*'): 'ref',
+            ('boolean', 'truefalse', '*'): 'ref',
+            ('text', 'file', '*'): 'file',
+            ('integer', 'slider', '*'): 'int',
+            ('text', 'descriptive', '*'): 'text'
+        }
+        if Emx2.config.has_section('redcap.datatype'):
+            for key, columnType in Emx2.config['redcap.datatype'].items():
+                parts = [k.strip() for k in key.split(',')]
+                if len(parts) != 3 or not all(parts[:2]) or not columnType.strip():
+                    raise src.exceptions.InvalidDatatype(f'{key} = {columnType}')
+                DataType, FieldType, TextValidationType = parts
+                dict[(DataType, FieldType, TextValidationType or '*')] = columnType.strip()
+        return dict
 
     def REDCap_datatype(dataframe: pd.DataFrame) -> pd.DataFrame:
         '''Determine the emx2 datatype based on REDCAP DataType, FieldType and TextValidationType
-        
-        Order of events is important'''
-        def datatype_list() -> dict:
-            '''Defines the columnType for EMX to convert to and return a dictionary
-            
-            Order is important'''
-            dict = {
-                1: {'DataType': 'text', 'FieldType': 'text', 'TextValidationType': 'email', 'columnType': 'text'},
-                2: {'DataType': 'date', 'FieldType': 'text', 'TextValidationType': '', 'columnType': 'date'},
-                3: {'DataType': 'partialDatetime', 'FieldType': 'text', 'TextValidationType': '', 'columnType': 'datetime'},
-                4: {'DataType': 'datetime', 'FieldType': 'text', 'TextValidationType': '', 'columnType': 'datetime'},
-                5: {'DataType': 'text', 'FieldType': 'text', 'TextValidationType': '', 'columnType': 'text'},
-                6: {'DataType': 'integer', 'FieldType': 'text', 'TextValidationType': '', 'columnType': 'int'},
-                7: {'DataType': 'float', 'FieldType': 'text', 'TextValidationType': '', 'columnType': 'decimal'},
-                8: {'DataType': 'partialTime', 'FieldType': 'text', 'TextValidationType': '', 'columnType': 'string'},
-                9: {'DataType': 'text', 'FieldType': 'textarea', 'TextValidationType': '', 'columnType': 'text'},
-                10: {'DataType': 'float', 'FieldType': 'calc', 'TextValidationType': '', 'columnType': 'decimal'},
-                11: {'DataType': 'text', 'FieldType': 'select', 'TextValidationType': '', 'columnType': 'text'},
-                12: {'DataType': 'text', 'FieldType': 'radio', 'TextValidationType': '', 'columnType': 'text'},
-                13: {'DataType': 'boolean', 'FieldType': 'checkbox', 'TextValidationType': '', 'columnType': 'ref_array'},
-                14: {'DataType': 'boolean', 'FieldType': 'yesno', 'TextValidationType': '', 'columnType': 'ref'},
-                15: {'DataType': 'boolean', 'FieldType': 'truefalse', 'TextValidationType': '', 'columnType': 'ref'},
-                16: {'DataType': 'text', 'FieldType': 'file', 'TextValidationType': '', 'columnType': 'file'},
-                17: {'DataType': 'integer', 'FieldType': 'slider', 'TextValidationType': '', 'columnType': 'int'},
-                18: {'DataType': 'text', 'FieldType': 'descriptive', 'TextValidationType': '', 'columnType': 'text'}
-            }
-            return dict
-
-        datatypes = datatype_list()
-        
-        for i in datatypes:
-            if datatypes[i]['TextValidationType']:
-                dataframe.loc[
-                    (dataframe['DataType'] == datatypes[i]['DataType']) &
-                    (dataframe['FieldType'] == datatypes[i]['FieldType']) & 
-                    (dataframe['TextValidationType'] == datatypes[i]['TextValidationType']), 'columnType'] =  datatypes[i]['columnType']
-            else:
-                dataframe.loc[
-                    (dataframe['DataType'] == datatypes[i]['DataType']) &
-                    (dataframe['FieldType'] == datatypes[i]['FieldType']), 'columnType'] =  datatypes[i]['columnType']
-        return dataframe
\ No newline at end of file
+
+        One lookup per row: (DataType, FieldType, TextValidationType) first, then (DataType, FieldType, '*').
+        Rows without DataType (table and key rows) keep their columnType, unmapped combinations are reported and
+        become string, the EMX2 default for a column without a type'''
+        datatypes = Emx2.datatype_list()
+
+        def column_type(DataType: str, FieldType: str, TextValidationType: str) -> str:
+            return datatypes.get((DataType, FieldType, TextValidationType)) or datatypes.get((DataType, FieldType, '*'))
+
+        variables = dataframe['DataType'].notna()
+        if not variables.any():
+            return dataframe
+
+        keys = dataframe.loc[variables, ['DataType', 'FieldType', 'TextValidationType']].fillna('')
+        columnTypes = pd.Series(
+            [column_type(*key) for key in keys.itertuples(index=False, name=None)],
+            index=keys.index, dtype=object)
+
+        unmapped = columnTypes.isna()
+        if unmapped.any():
+            for key in keys[unmapped].drop_duplicates().itertuples(index=False, name=None):
+                logger.warning(f'No EMX2 columnType for REDCap DataType={key[0]}, FieldType={key[1]}, TextValidationType={key[2]}, using string')
+            columnTypes[unmapped] = 'string'
+
+        dataframe.loc[variables, 'columnType'] = columnTypes
+        return dataframe
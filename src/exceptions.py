@@ -1,3 +1,5 @@
+from typing import List
+
 
 class Error(Exception):
     pass
@@ -33,4 +35,61 @@ class NoClinicalData(Error):
         super().__init__()
     
     def __str__(self):
-        return f'{self.message}'
\ No newline at end of file
+        return f'{self.message}'
+
+class InvalidXml(Error):
+    def __init__(self) -> None:
+        self.message = 'ParseError, please provide valid xml file.'
+        super().__init__()
+    
+    def __str__(self):
+        return f'{self.message}'
+
+class NoNamespace(Error):
+    def __init__(self) -> None:
+        self.message = 'Failed to retrieve namespace.'
+        super().__init__()
+    
+    def __str__(self):
+        return f'{self.message}'
+
+class NoParser(Error):
+    def __init__(self, parser: str) -> None:
+        self.message = f'Parser {parser} not available, select etree or lxml (pip install lxml).'
+        super().__init__()
+    
+    def __str__(self):
+        return f'{self.message}'
+
+class NoColumnar(Error):
+    def __init__(self, columnar: str) -> None:
+        self.message = f'Columnar output {columnar} not available, select parquet or arrow (pip install pyarrow).'
+        super().__init__()
+    
+    def __str__(self):
+        return f'{self.message}'
+
+class NoForm(Error):
+    def __init__(self, forms: List[str]) -> None:
+        self.message = f'Form(s) {", ".join(forms)} not found, select by FormName or FormOID.'
+        super().__init__()
+    
+    def __str__(self):
+        return f'{self.message}'
+
+class ErrorWritingInstrument(Error):
+    def __init__(self, instrument: str) -> None:
+        self.message = f'Writing {instrument}.csv failed.'
+        # the argument lets a worker process send the exception back (pickle)
+        super().__init__(instrument)
+    
+    def __str__(self):
+        return f'{self.message}'
+
+class InvalidDatatype(Error):
+    def __init__(self, rule: str) -> None:
+        self.message = f'Invalid [redcap.datatype] rule "{rule}" in src/config.ini, use DataType,FieldType,TextValidationType = columnType.'
+        super().__init__()
+    
+    def __str__(self):
+        return f'{self.message}'
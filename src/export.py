@@ -2,11 +2,30 @@
 #from abc import ABC, abstractmethod
 
 import configparser
+import contextlib
+import io
+import logging
+import os
 import src.exceptions
 import pathlib
 import pandas as pd
+import zipfile
+from typing import Dict, Iterator
+
+logger = logging.getLogger(__name__)
 
 class export():
+    config = configparser.ConfigParser()
+    config.read('./src/config.ini')
+
+    output_folder = config['settings']['output_folder']
+    output_format = config['settings'].get('output_format', 'csv') # csv, gzip or zip
+    bundle = config['settings'].get('bundle', 'emx2.zip')
+    columnar = config['settings'].get('columnar', '') # empty, parquet or arrow: a typed copy of every data table
+
+    # file extension of the columnar formats and the arrow type of an EMX2 columnType (others are strings)
+    columnar_formats = {'parquet': '.parquet', 'arrow': '.arrow'}
+    arrow_types = {'int': 'int64', 'decimal': 'float64', 'bool': 'bool', 'date': 'date32', 'datetime': 'timestamp[s]'}
 
     def is_dir(dir: pathlib.PosixPath) -> None:
         if not dir.is_dir():
@@ -22,32 +41,128 @@ class export():
         try:
             dir.rmdir()
         except OSError as e:
-            print(f"Error:{ e.strerror}")
+            logger.error(f"Error:{ e.strerror}")
 
     def delete_files(dir: pathlib.PosixPath) -> None:
         def delete_file(file: pathlib.PosixPath) -> None:
             try:
                 file.unlink()
             except OSError as e:
-                print(f"Error:{ e.strerror}")
+                logger.error(f"Error:{ e.strerror}")
 
         for file in dir.iterdir():
             delete_file(file)
 
     def create_dir(dir: pathlib.PosixPath) -> None:
+        if dir.is_dir():
+            # is_empty() (re)creates the folder it just emptied, or that already was empty
+            logger.debug(f'Output folder {dir} exists')
+            return
         try:
             dir.mkdir(parents=False, exist_ok=False)
         except OSError as e:
-            print(f"Error:{ e.strerror}")
+            logger.error(f"Error:{ e.strerror}")
     
-    def instrument_to_csv(data: pd.DataFrame, file: str) -> None:
-        config = configparser.ConfigParser()
-        config.read('src/config.ini')
-        output = pathlib.Path().joinpath(config['settings']['output_folder'], file)
-        if not output.is_file():
-            data.to_csv(output, index=False, header=True)
-        elif output.is_file():
-            data.to_csv(output, index=False, header=False, mode='a')
-        else:
+    def output_path(file: str) -> pathlib.Path:
+        '''path of the written table in the output folder, (file.csv.gz for gzip)'''
+        output = pathlib.Path().joinpath(export.output_folder, file)
+        return output.with_name(f'{file}.gz') if export.output_format == 'gzip' else output
+
+    def bundled() -> bool:
+        '''True if tables are written into a single zip instead of separate files'''
+        return export.output_format == 'zip'
+
+    def instrument_to_csv(data: pd.DataFrame, file: str, output_folder: str = None) -> None:
+        '''write the final table in one pass, as plain csv, gzip (file.csv.gz) or an entry of the zip bundle
+
+        output_folder defaults to export.output_folder (config.ini, or the folder set by run.Transform)'''
+        output_folder = pathlib.Path().joinpath(output_folder or export.output_folder)
+        try:
+            if export.output_format == 'csv':
+                export.write_file(data, output_folder.joinpath(file), None)
+            elif export.output_format == 'gzip':
+                export.write_file(data, output_folder.joinpath(f'{file}.gz'), {'method': 'gzip', 'mtime': 0})
+            elif export.output_format == 'zip':
+                export.write_bundle(data, output_folder.joinpath(export.bundle), file)
+            else:
+                raise src.exceptions.ErrorWritingCsv()
+        except OSError:
             raise src.exceptions.ErrorWritingCsv()
 
+    @contextlib.contextmanager
+    def atomic_path(output: pathlib.Path) -> Iterator[pathlib.Path]:
+        '''temporary path next to output to write to, moved in place when the block ends and removed if it fails,
+        so a file is either complete or not there'''
+        output = pathlib.Path(output)
+        temp = output.with_name(f'.{output.name}.{os.getpid()}.tmp')
+        try:
+            yield temp
+            os.replace(temp, output)
+        except BaseException:
+            temp.unlink(missing_ok=True)
+            raise
+
+    def write_file(data: pd.DataFrame, output: pathlib.Path, compression: dict) -> None:
+        with export.atomic_path(output) as temp:
+            data.to_csv(temp, index=False, header=True, compression=compression)
+
+    def write_bundle(data: pd.DataFrame, bundle: pathlib.Path, file: str) -> None:
+        # stream the csv straight into the zip entry, no intermediate file
+        with zipfile.ZipFile(bundle, 'a', compression=zipfile.ZIP_DEFLATED) as zip:
+            with zip.open(file, 'w') as entry, io.TextIOWrapper(entry, encoding='utf-8', newline='') as csv:
+                data.to_csv(csv, index=False, header=True)
+
+    def pyarrow():
+        '''pyarrow, optional: pip install pyarrow, raises NoColumnar if columnar is not parquet or arrow or pyarrow is missing'''
+        if export.columnar not in export.columnar_formats:
+            raise src.exceptions.NoColumnar(export.columnar)
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            raise src.exceptions.NoColumnar(export.columnar)
+        return pyarrow
+
+    def columnar_path(file: str, output_folder: str = None) -> pathlib.Path:
+        '''path of the columnar copy of a table (file.csv -> file.parquet or file.arrow)'''
+        output = pathlib.Path().joinpath(output_folder or export.output_folder, file)
+        return output.with_suffix(export.columnar_formats[export.columnar])
+
+    def instrument_to_columnar(data: pd.DataFrame, file: str, column_types: Dict[str, str] = None, output_folder: str = None) -> None:
+        '''write a typed copy of the table as parquet (compressed) or arrow IPC (uncompressed, can be memory-mapped)
+
+        column types follow the EMX2 columnType (column_types: columnName -> columnType), columns without one are strings,
+        values that do not fit the type become null'''
+        pa = export.pyarrow()
+        column_types = column_types or {}
+
+        def column(values: pd.Series, columnType: str) -> 'pa.Array':
+            arrow_type = pa.type_for_alias(export.arrow_types.get(columnType, 'string'))
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype(object)
+            if columnType == 'int':
+                values = pd.to_numeric(values, errors='coerce').astype('Int64')
+            elif columnType == 'decimal':
+                values = pd.to_numeric(values, errors='coerce')
+            elif columnType == 'bool':
+                values = values.map({'TRUE': True, 'FALSE': False, '1': True, '0': False})
+            elif columnType in ('date', 'datetime'):
+                values = pd.to_datetime(values, errors='coerce')
+            return pa.array(values, type=arrow_type, from_pandas=True)
+
+        # a collapsed checkbox (ref_array) can appear more than once in the csv, a column name is used once here
+        data = data.loc[:, ~data.columns.duplicated()]
+        table = pa.Table.from_arrays(
+            [column(data[name], column_types.get(name)) for name in data.columns],
+            names=[str(name) for name in data.columns])
+
+        try:
+            with export.atomic_path(export.columnar_path(file, output_folder)) as temp:
+                if export.columnar == 'parquet':
+                    pa.parquet.write_table(table, temp)
+                else:
+                    with pa.OSFile(str(temp), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+        except OSError:
+            raise src.exceptions.ErrorWritingCsv()
@@ -1,18 +1,27 @@
 '''instrument variables and repeatedVariables'''
 from abc import ABC, abstractmethod
+import logging
+from typing import Union
 
+import src.cdisc
 import src.exceptions
+import src.manifest
 import src.REDCap.instrument
 import src.REDCap.utils
 #from exceptions import NoValidEdc
 #from REDCap.instrument import REDCapInstrument
 #from REDCap.utils import study_contains_clinicaldata
 
+logger = logging.getLogger(__name__)
+
 class Instrument(ABC):
     
-    def __init__(self, edc: str, file: str) -> None:
+    def __init__(self, edc: str, xml: src.cdisc.Cdisc, workers: int = 1, manifest: src.manifest.Manifest = None, staging: Union[bool, str] = False) -> None:
         self.edc = edc
-        self.file = file
+        self.xml = xml
+        self.workers = workers
+        self.manifest = manifest
+        self.staging = staging
         super().__init__()
     
     @abstractmethod
@@ -22,9 +31,9 @@ class Instrument(ABC):
 class SubjectData(Instrument):
 
     def execute(self) -> None:
-        print(f"Subjects, EDC: {self.edc}, file: {self.file}")
+        logger.info(f"Subjects, EDC: {self.edc}, file: {self.xml.file}")
         if self.edc == 'REDCap':
-            src.REDCap.instrument.REDCapInstrument(self.file).subject_data_table()
+            src.REDCap.instrument.REDCapInstrument(self.xml, manifest=self.manifest).subject_data_table()
         elif self.edc == 'Castor':
             pass
         else:
@@ -33,16 +42,16 @@ class SubjectData(Instrument):
 class Variables(Instrument):
 
     def execute(self) -> None:
-        print(f"Intrument variables, EDC: {self.edc}, file: {self.file}")
+        logger.info(f"Intrument variables, EDC: {self.edc}, file: {self.xml.file}")
         if self.edc == 'REDCap':
-            src.REDCap.instrument.REDCapInstrument(self.file).instrument_data_table()
+            src.REDCap.instrument.REDCapInstrument(self.xml, self.workers, self.manifest, self.staging).instrument_data_table()
         elif self.edc == 'Castor':
             pass
         else:
             raise src.exceptions.NoValidEdc
 
-def instruments(edc, file) -> None:
-    src.REDCap.utils.study_contains_clinicaldata(file)
+def instruments(edc: str, xml: src.cdisc.Cdisc, workers: int = 1, manifest: src.manifest.Manifest = None, staging: Union[bool, str] = False) -> None:
+    src.REDCap.utils.study_contains_clinicaldata(xml)
     
-    SubjectData(edc, file).execute()
-    Variables(edc, file).execute()
\ No newline at end of file
+    SubjectData(edc, xml, manifest=manifest).execute()
+    Variables(edc, xml, workers, manifest, staging).execute()
\ No newline at end of file
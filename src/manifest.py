@@ -0,0 +1,65 @@
+'''manifest of content hashes for incremental runs'''
+import hashlib
+import json
+import logging
+import pathlib
+from typing import Dict
+
+import src.export
+
+logger = logging.getLogger(__name__)
+
+class Manifest:
+    '''Content hashes of the tables written by the previous run, stored as .manifest.json in the output folder
+
+    A table whose hash did not change, and whose file still exists, is not generated or written again.
+    Tables that are no longer produced are removed from the output folder on save()'''
+    file = '.manifest.json'
+
+    def __init__(self, output_folder: pathlib.Path) -> None:
+        self.path = pathlib.Path(output_folder).joinpath(self.file)
+        self.output_format = src.export.export.output_format
+        self.columnar = src.export.export.columnar
+        self.previous: Dict[str, str] = {}
+        self.tables: Dict[str, str] = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('output_format') == self.output_format and manifest.get('columnar', '') == self.columnar:
+                self.previous = manifest.get('tables', {})
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def compatible(self) -> bool:
+        '''True if a previous manifest for the same output format (and columnar copies) was found'''
+        return bool(self.previous)
+
+    def unchanged(self, table: str, digest: str, columnar: bool = False) -> bool:
+        '''record the hash of table and return True if it equals the previous run and the file still exists
+
+        columnar: the table also has a columnar copy (data tables), that has to exist as well if columnar is set'''
+        self.tables[table] = digest
+        if self.previous.get(table) != digest or not src.export.export.output_path(table).is_file():
+            return False
+        return not (columnar and self.columnar) or src.export.export.columnar_path(table).is_file()
+
+    def save(self) -> None:
+        '''remove tables of the previous run that are gone and write the manifest'''
+        for table in self.previous.keys() - self.tables.keys():
+            output = src.export.export.output_path(table)
+            if output.is_file():
+                logger.info(f'Removing {table}')
+                output.unlink()
+            if self.columnar and src.export.export.columnar_path(table).is_file():
+                src.export.export.columnar_path(table).unlink()
+
+        with src.export.export.atomic_path(self.path) as temp, open(temp, 'w', encoding='utf-8') as f:
+            json.dump({'output_format': self.output_format, 'columnar': self.columnar, 'tables': self.tables}, f, indent=2, sort_keys=True)
+
+def digest(*parts: str) -> str:
+    '''sha256 of the given parts'''
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(str(part).encode('utf-8'))
+        sha.update(b'\x1e')
+    return sha.hexdigest()
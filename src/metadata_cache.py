@@ -0,0 +1,152 @@
+'''persistent cache of results derived from the MetaDataVersion, keyed by a hash of its content'''
+import hashlib
+import json
+import logging
+import pathlib
+import re
+from typing import Callable, Dict
+import pandas as pd
+
+import src.cdisc
+import src.export
+
+logger = logging.getLogger(__name__)
+
+# bump when a cached result changes shape, older cache files are then never read
+VERSION = 2
+
+METADATA_START = re.compile(rb'<(?:[\w.-]+:)?MetaDataVersion\b[^>]*>')
+METADATA_END = re.compile(rb'</(?:[\w.-]+:)?MetaDataVersion\s*>')
+
+
+def metadata_digest(file: str, chunk_size: int = 1024 ** 2) -> str:
+    '''sha256 of the content of the first MetaDataVersion (FormDef, ItemGroupDef, ItemDef, CodeList ..), None if there is none
+
+    the bytes are read up to its end tag only. The attributes of the MetaDataVersion itself (its OID holds the export date)
+    are left out, so every export of an unchanged data dictionary has the same digest'''
+    sha = hashlib.sha256()
+    buffer = b''
+    inside = False
+    with open(file, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            buffer += chunk
+            if not inside:
+                match = METADATA_START.search(buffer)
+                if not match:
+                    # keep a start tag that is split over two chunks
+                    start = buffer.rfind(b'<')
+                    buffer = buffer[start:] if start >= 0 else b''
+                    continue
+                inside = True
+                buffer = buffer[match.end():]
+            match = METADATA_END.search(buffer)
+            if match:
+                sha.update(buffer[:match.start()])
+                return sha.hexdigest()
+            # keep an end tag that is split over two chunks
+            sha.update(buffer[:-256])
+            buffer = buffer[-256:]
+    return None
+
+
+def encode(value: object) -> object:
+    '''JSON value of a cached result, every dict, tuple, DataFrame and MetaDataIndex is tagged by its type'''
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, list):
+        return [encode(i) for i in value]
+    if isinstance(value, tuple):
+        return {'tuple': [encode(i) for i in value]}
+    if isinstance(value, dict):
+        if not all(isinstance(key, str) for key in value):
+            raise TypeError('metadata cache: dict keys must be str')
+        return {'dict': {key: encode(i) for key, i in value.items()}}
+    if isinstance(value, src.cdisc.MetaDataIndex):
+        return {'MetaDataIndex': encode(vars(value))}
+    if isinstance(value, pd.DataFrame):
+        index = value.index
+        return {'DataFrame': {
+            'columns': encode(list(value.columns)),
+            'dtypes': [str(dtype) for dtype in value.dtypes],
+            'index': {'range': [index.start, index.stop, index.step]} if isinstance(index, pd.RangeIndex) else encode(index.tolist()),
+            'data': [encode(value.iloc[:, position].tolist()) for position in range(value.shape[1])]
+        }}
+    raise TypeError(f'metadata cache: {type(value).__name__} is not stored')
+
+def decode(value: object) -> object:
+    '''cached result of a JSON value written by encode()'''
+    if isinstance(value, list):
+        return [decode(i) for i in value]
+    if not isinstance(value, dict):
+        return value
+    (kind, value), = value.items()
+    if kind == 'tuple':
+        return tuple(decode(i) for i in value)
+    if kind == 'dict':
+        return {key: decode(i) for key, i in value.items()}
+    if kind == 'MetaDataIndex':
+        index = src.cdisc.MetaDataIndex.__new__(src.cdisc.MetaDataIndex)
+        vars(index).update(decode(value))
+        return index
+    if kind == 'DataFrame':
+        index = value['index']
+        index = pd.RangeIndex(*index['range']) if isinstance(index, dict) else pd.Index(decode(index))
+        columns = decode(value['columns'])
+        return pd.DataFrame(
+            {position: pd.Series(decode(data), index=index, dtype=dtype) for position, (data, dtype) in enumerate(zip(value['data'], value['dtypes']))},
+            index=index).set_axis(columns, axis=1)
+    raise ValueError(f'metadata cache: unknown {kind}')
+
+
+class MetadataCache:
+    '''results derived from the MetaDataVersion (index, datamodel, codelists ..) stored as one JSON file per key in folder
+
+    the key is the metadata digest plus everything else the results depend on (form selection, config.ini settings),
+    a result is computed once per data dictionary and read back by every later run. The files are only read as data
+    (json, no pickle), a changed cache file can give wrong output but does not run code'''
+
+    def __init__(self, folder: str, digest: str, *parts: object) -> None:
+        key = hashlib.sha256(repr((VERSION, digest, parts)).encode('utf-8')).hexdigest()
+        self.path = pathlib.Path(folder).joinpath(f'{key}.json')
+        self.values: Dict[str, object] = {}
+        # name -> JSON value, a result is decoded when it is used and encoded once when it is computed
+        self.encoded: Dict[str, object] = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.encoded = dict(json.load(f))
+            logger.info(f'Metadata cache {self.path.name}')
+        except FileNotFoundError:
+            pass
+        except Exception: # unreadable (truncated, not JSON), computed again and replaced
+            logger.warning(f'Ignoring metadata cache {self.path}')
+
+    def get(self, name: str, query: Callable[[], object]) -> object:
+        '''cached result of query, computed and stored if it is not in the cache'''
+        if name not in self.values:
+            try:
+                self.values[name] = decode(self.encoded[name])
+            except KeyError:
+                pass
+            except Exception:
+                logger.warning(f'Ignoring {name} in metadata cache {self.path}')
+            if name not in self.values:
+                self.values[name] = query()
+                self.encoded[name] = encode(self.values[name])
+                self.save()
+        return self.values[name]
+
+    def save(self) -> None:
+        '''write the cache, through a temporary file so a concurrent run never reads half of it'''
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with src.export.export.atomic_path(self.path) as temp, open(temp, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.encoded, separators=(',', ':')))
+
+
+def metadata_cache(folder: str, file: str, *parts: object) -> MetadataCache:
+    '''the cache for the MetaDataVersion of file, None if folder is not set or the file has no MetaDataVersion'''
+    if not folder:
+        return None
+    digest = metadata_digest(file)
+    if digest is None:
+        return None
+    return MetadataCache(folder, digest, *parts)
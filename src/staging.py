@@ -0,0 +1,80 @@
+'''on-disk staging store for ClinicalData larger than memory (SQLite)'''
+import itertools
+import os
+import sqlite3
+import tempfile
+from typing import Dict, Iterable, Iterator, Tuple
+import pandas as pd
+
+Item = Tuple[str, str, str, str, str]
+
+
+class Staging:
+    '''ClinicalData in long format (SubjectKey, FormRepeatKey, FormOID, ItemOID, Value) in a temporary SQLite database
+
+    Items are appended in batches while the file is read, the rowid keeps the order in which they were read.
+    After load() every form is read back on its own, so only one instrument is in memory at a time.
+    The database is scratch data: no journal, no sync, removed on close()
+
+    with Staging(folder) as store:
+        store.load(items)
+        records = store.form_records(FormOID)'''
+    batch = 50000
+
+    def __init__(self, folder: str = None) -> None:
+        handle, self.path = tempfile.mkstemp(prefix='.staging.', suffix='.sqlite', dir=folder)
+        os.close(handle)
+        self.count = 0
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript('''
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE items (SubjectKey TEXT, FormRepeatKey TEXT, FormOID TEXT, ItemOID TEXT, Value TEXT);
+        ''')
+
+    def __enter__(self) -> 'Staging':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def load(self, items: Iterable[Item]) -> None:
+        '''store items, batch by batch, then index them by form and number the rows (SubjectKey, FormRepeatKey) in read order'''
+        items = iter(items)
+        while batch := list(itertools.islice(items, self.batch)):
+            self.connection.executemany('INSERT INTO items VALUES (?, ?, ?, ?, ?)', batch)
+            self.count += len(batch)
+        self.connection.executescript('''
+            CREATE INDEX items_form ON items (FormOID, SubjectKey, FormRepeatKey, ItemOID);
+            CREATE TABLE rows AS
+                SELECT SubjectKey, FormRepeatKey, MIN(rowid) AS seq FROM items GROUP BY SubjectKey, FormRepeatKey;
+            CREATE INDEX rows_key ON rows (SubjectKey, FormRepeatKey);
+        ''')
+        self.connection.commit()
+
+    def items(self) -> Iterator[Item]:
+        '''all items in the order they were read'''
+        yield from self.connection.execute('SELECT SubjectKey, FormRepeatKey, FormOID, ItemOID, Value FROM items ORDER BY rowid')
+
+    def form_records(self, FormOID: str) -> Dict[str, list]:
+        '''the items of one form as clinical data records, in the order they were read'''
+        cursor = self.connection.execute(
+            'SELECT SubjectKey, FormRepeatKey, FormOID, ItemOID, Value FROM items WHERE FormOID = ? ORDER BY rowid', (FormOID,))
+        columns = [column[0] for column in cursor.description]
+        return dict(zip(columns, map(list, zip(*cursor.fetchall())))) or {column: [] for column in columns}
+
+    def form_rows(self, FormOID: str) -> pd.MultiIndex:
+        '''the rows (SubjectKey, FormRepeatKey) that have items of one form, in the order they were first read in the whole file'''
+        rows = self.connection.execute('''
+            SELECT rows.SubjectKey, rows.FormRepeatKey FROM rows
+            JOIN (SELECT DISTINCT SubjectKey, FormRepeatKey FROM items WHERE FormOID = ?) form USING (SubjectKey, FormRepeatKey)
+            ORDER BY rows.seq''', (FormOID,)).fetchall()
+        return pd.MultiIndex.from_tuples(rows, names=['SubjectKey', 'FormRepeatKey']) if rows else \
+            pd.MultiIndex.from_arrays([[], []], names=['SubjectKey', 'FormRepeatKey'])
+
+    def close(self) -> None:
+        self.connection.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,118 @@
+'''nested timing and memory spans for a transform, written as JSON report and/or to logging'''
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def peak_rss() -> float:
+    '''peak resident memory of this process in MB, None if not available (Windows)'''
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 ** 2 if sys.platform == 'darwin' else maxrss / 1024
+
+
+class Span:
+    '''a timed part of the transform: wall and CPU time (s), peak RSS at the end (MB), optional row count'''
+    __slots__ = ('tracer', 'name', 'attributes', 'rows', 'children', 'wall', 'cpu', 'peak_rss_mb', '_wall', '_cpu')
+
+    def __init__(self, tracer: 'Tracer', name: str, attributes: Dict[str, object]) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.rows = None
+        self.children: List[Dict[str, object]] = []
+
+    def __enter__(self) -> 'Span':
+        self.tracer.stack.append(self)
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+        self.peak_rss_mb = peak_rss()
+        if self.peak_rss_mb is not None:
+            self.peak_rss_mb = round(self.peak_rss_mb, 1)
+        self.tracer.stack.pop()
+        self.tracer.finish(self.to_dict(), depth=len(self.tracer.stack))
+
+    def to_dict(self) -> Dict[str, object]:
+        span = {'name': self.name, **self.attributes, 'wall': round(self.wall, 4), 'cpu': round(self.cpu, 4), 'peak_rss_mb': self.peak_rss_mb}
+        if self.rows is not None:
+            span['rows'] = self.rows
+        if self.children:
+            span['children'] = self.children
+        return span
+
+
+class NullSpan:
+    '''span of a disabled tracer, does nothing'''
+    __slots__ = ()
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+    def __setattr__(self, name: str, value: object) -> None:
+        pass
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    '''collects nested spans, disabled unless a report is asked for or logging is at DEBUG level
+
+    with tracer.span('instrument', instrument='demographics') as span:
+        span.rows = len(data)'''
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.stack: List[Span] = []
+        self.spans: List[Dict[str, object]] = []
+
+    def span(self, name: str, **attributes: object) -> Span:
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attributes)
+
+    def finish(self, span: Dict[str, object], depth: int) -> None:
+        '''add a finished span to its parent (or the report) and log it'''
+        (self.stack[-1].children if self.stack else self.spans).append(span)
+        if logger.isEnabledFor(logging.DEBUG):
+            label = [span['name']] + [str(v) for k, v in span.items() if k not in ('name', 'wall', 'cpu', 'peak_rss_mb', 'rows', 'children')]
+            rows = f', {span["rows"]} rows' if 'rows' in span else ''
+            logger.debug(f'{"  " * depth}{" ".join(label)} {span["wall"]:.3f}s (cpu {span["cpu"]:.3f}s, peak {span["peak_rss_mb"]} MB{rows})')
+
+    def attach(self, spans: List[Dict[str, object]]) -> None:
+        '''add spans recorded elsewhere (a worker process) to the current span'''
+        if self.enabled:
+            (self.stack[-1].children if self.stack else self.spans).extend(spans)
+
+    def report(self) -> Dict[str, object]:
+        return {'pid': os.getpid(), 'spans': self.spans}
+
+    def write(self, file: str) -> None:
+        with open(file, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+# the tracer of the running transform, replaced by run.Transform
+tracer = Tracer()
+
+def span(name: str, **attributes: object) -> Span:
+    '''span on the tracer of the running transform'''
+    return tracer.span(name, **attributes)
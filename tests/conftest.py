@@ -0,0 +1,25 @@
+'''the tests run from the repository root, src/config.ini and data/input are read relative to it'''
+import os
+import pathlib
+import sys
+from typing import Callable, Dict
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+os.chdir(ROOT)
+sys.path.insert(0, str(ROOT))
+
+import run
+
+
+@pytest.fixture
+def transform(tmp_path_factory: pytest.TempPathFactory) -> Callable[..., Dict[str, bytes]]:
+    '''run.Transform on a file (name in data/input or a path) into output (default a new folder),
+    returns file name -> content of the tables in output (.manifest.json left out)'''
+    def transform(file: str, output: pathlib.Path = None, **kwargs: object) -> Dict[str, bytes]:
+        output = output or tmp_path_factory.mktemp('output')
+        run.Transform(edc='REDCap', file=str(file), output=str(output), **kwargs)
+        return {path.name: path.read_bytes() for path in sorted(output.iterdir()) if not path.name.startswith('.')}
+    return transform
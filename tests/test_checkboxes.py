@@ -0,0 +1,71 @@
+'''the items of a checkbox (variable___1 ..) are one ref_array column, the codes of the checked choices'''
+import csv
+import io
+import os
+import pathlib
+from typing import Dict
+
+import pandas as pd
+import pytest
+
+import src.REDCap.utils
+
+INPUT = pathlib.Path('data/input')
+EXAMPLE = 'Example_1_REDCap_meta.xml'
+
+
+def checked(tmp_path: pathlib.Path, codes: Dict[str, str] = None) -> pathlib.Path:
+    '''Example 1 with choices 2 and 5 of cb_multiple_1 checked for subject 1, codes: old -> new code of a choice'''
+    text = INPUT.joinpath(EXAMPLE).read_text(encoding='utf-8')
+    for item in ('cb_multiple_1___2', 'cb_multiple_1___5'):
+        # the first ItemData of an item is that of subject 1
+        text = text.replace(f'<ItemData ItemOID="{item}" Value="0"/>', f'<ItemData ItemOID="{item}" Value="1"/>', 1)
+    for old, new in (codes or {}).items():
+        text = text.replace(f'CheckboxChoices="{old}, ', f'CheckboxChoices="{new}, ').replace(f'| {old}, ', f'| {new}, ')
+    file = tmp_path.joinpath(f'checked_{len(codes or {})}.xml')
+    file.write_text(text, encoding='utf-8')
+    return file
+
+def column(table: bytes, name: str) -> Dict[str, str]:
+    '''key -> value of a column of a written table'''
+    return {row['key']: row[name] for row in csv.DictReader(io.StringIO(table.decode('utf-8')))}
+
+
+def test_collapse() -> None:
+    checkboxes = {'cb___1': ('cb', 'a'), 'cb___2': ('cb', 'b'), 'cb___3': ('cb', 'c')}
+    data = pd.DataFrame([
+        ('1', '1', 'Form.f', 'cb___1', '1'),
+        ('1', '1', 'Form.f', 'cb___2', '0'),
+        ('1', '1', 'Form.f', 'cb___3', '1'),
+        ('1', '1', 'Form.f', 'text', 'x'),
+        ('2', '1', 'Form.f', 'cb___1', '0'),
+        ('2', '1', 'Form.f', 'cb___2', '0')
+    ], columns=['SubjectKey', 'FormRepeatKey', 'FormOID', 'ItemOID', 'Value'])
+    result = src.REDCap.utils.collapse_checkboxes(data, checkboxes)
+    values = {(SubjectKey, ItemOID): Value for SubjectKey, ItemOID, Value in result[['SubjectKey', 'ItemOID', 'Value']].itertuples(index=False)}
+    assert values[('1', 'text')] == 'x'
+    assert values[('1', 'cb')] == 'a,c'
+    # read, but none checked
+    assert pd.isna(values[('2', 'cb')])
+    assert len(result) == 3
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_checked(stream: bool, tmp_path: pathlib.Path, transform) -> None:
+    tables = transform(checked(tmp_path), stream=stream)
+    assert column(tables['test_field_types.csv'], 'cb_multiple_1') == {'1_1': '2,5', '2_1': '', '3_1': '', '4_1': '6,7'}
+    assert b'\ncb_multiple_1___' not in tables['molgenis.csv']
+
+def test_codes(tmp_path: pathlib.Path, transform) -> None:
+    '''the values are the codes of the CheckboxChoices, not the ___ suffix of the items'''
+    tables = transform(checked(tmp_path, {'2': '20'}))
+    assert column(tables['test_field_types.csv'], 'cb_multiple_1') == {'1_1': '20,5', '2_1': '', '3_1': '', '4_1': '6,7'}
+
+def test_incremental_codes(tmp_path: pathlib.Path, transform) -> None:
+    '''an instrument is written again if only the codes of its checkbox choices change'''
+    output = tmp_path.joinpath('output')
+    transform(checked(tmp_path), output, incremental=True)
+    for path in output.iterdir():
+        os.utime(path, ns=(0, 0))
+    file = checked(tmp_path, {'2': '20'})
+    assert transform(file, output, incremental=True) == transform(file)
+    assert output.joinpath('test_field_types.csv').stat().st_mtime_ns
@@ -0,0 +1,67 @@
+'''the EMX2 columnType of a REDCap (DataType, FieldType, TextValidationType) and the [redcap.datatype] rules of config.ini'''
+import csv
+import io
+from typing import Dict
+
+import pandas as pd
+import pytest
+
+import src.emx2
+import src.exceptions
+
+EXAMPLE = 'Example_2_REDCap_repeated-measures.xml'
+
+
+def column_types(molgenis: bytes) -> Dict[str, str]:
+    '''columnName -> columnType of the variables in molgenis.csv'''
+    return {row['columnName']: row['columnType'] for row in csv.DictReader(io.StringIO(molgenis.decode('utf-8'))) if row['columnName']}
+
+def datatypes(*keys: tuple) -> list:
+    dataframe = pd.DataFrame(list(keys), columns=['DataType', 'FieldType', 'TextValidationType'], dtype=object).assign(columnType=None)
+    return src.emx2.Emx2.REDCap_datatype(dataframe)['columnType'].tolist()
+
+
+def test_datatypes() -> None:
+    assert datatypes(
+        ('integer', 'text', None),
+        ('text', 'text', 'email'),
+        ('text', 'text', 'phone'),
+        ('boolean', 'checkbox', None),
+        ('date', 'text', 'date_dmy')) == ['int', 'text', 'text', 'ref_array', 'date']
+
+def test_unmapped() -> None:
+    '''an unknown combination is a string, as EMX2 does for a column without a type'''
+    assert datatypes(('blob', 'text', None), ('integer', 'text', None)) == ['string', 'int']
+
+def test_rules(monkeypatch: pytest.MonkeyPatch) -> None:
+    rules = src.emx2.Emx2.config['redcap.datatype']
+    monkeypatch.setitem(rules, 'text,text,phone', 'string')
+    monkeypatch.setitem(rules, 'blob, text, ', 'file')
+    # an exact TextValidationType takes precedence over the rule for any
+    assert datatypes(('text', 'text', 'phone'), ('text', 'text', 'email'), ('blob', 'text', 'x')) == ['string', 'text', 'file']
+
+@pytest.mark.parametrize('key, value', [
+    ('text,text', 'int'),
+    ('text,text,email,x', 'int'),
+    (',text,', 'int'),
+    ('text,text,', '')
+])
+def test_invalid_rule(key: str, value: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setitem(src.emx2.Emx2.config['redcap.datatype'], key, value)
+    with pytest.raises(src.exceptions.InvalidDatatype, match=key):
+        src.emx2.Emx2.datatype_list()
+
+def test_invalid_rule_nothing_written(tmp_path, transform, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setitem(src.emx2.Emx2.config['redcap.datatype'], 'integer,slider', 'decimal')
+    with pytest.raises(src.exceptions.InvalidDatatype):
+        transform(EXAMPLE, tmp_path.joinpath('output'))
+    assert not tmp_path.joinpath('output').exists()
+
+def test_example_rule(transform, monkeypatch: pytest.MonkeyPatch) -> None:
+    '''a rule changes the columnType of the matching variables only'''
+    full = column_types(transform(EXAMPLE)['molgenis.csv'])
+    monkeypatch.setitem(src.emx2.Emx2.config['redcap.datatype'], 'integer,slider,', 'decimal')
+    types = column_types(transform(EXAMPLE)['molgenis.csv'])
+    assert full['slider_1'] == 'int' and types['slider_1'] == 'decimal'
+    assert {name: columnType for name, columnType in types.items() if name != 'slider_1'} == \
+        {name: columnType for name, columnType in full.items() if name != 'slider_1'}
@@ -0,0 +1,68 @@
+'''incremental runs (.manifest.json) write only the tables that changed and give the same tables as a full run'''
+import importlib.util
+import os
+import pathlib
+from typing import Set
+
+import pytest
+
+import src.export
+
+INPUT = pathlib.Path('data/input')
+EXAMPLE = 'Example_4_TestHumanCancer_data_REDCap.xml'
+
+
+def age(output: pathlib.Path) -> None:
+    '''set the modification time of every file in output to 0, to see which ones the next run writes'''
+    for path in output.iterdir():
+        os.utime(path, ns=(0, 0))
+
+def written(output: pathlib.Path) -> Set[str]:
+    return {path.name for path in output.iterdir() if path.stat().st_mtime_ns and not path.name.startswith('.')}
+
+def new_subject(tmp_path: pathlib.Path) -> pathlib.Path:
+    '''Example 4 with a subject 3 that only has slide_tracking data'''
+    text = INPUT.joinpath(EXAMPLE).read_text(encoding='utf-8')
+    slide_tracking = text[text.rindex('<FormData FormOID="Form.slide_tracking"'):]
+    slide_tracking = slide_tracking[:slide_tracking.index('</FormData>') + len('</FormData>')]
+    subject = f'<SubjectData SubjectKey="3" redcap:RecordIdField="lab_id">{slide_tracking}</SubjectData>\n</ClinicalData>'
+    file = tmp_path.joinpath('new_subject.xml')
+    file.write_text(text.replace('</ClinicalData>', subject), encoding='utf-8')
+    return file
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_unchanged(tmp_path: pathlib.Path, transform, stream: bool) -> None:
+    full = transform(EXAMPLE)
+    assert transform(EXAMPLE, tmp_path, incremental=True, stream=stream) == full
+    age(tmp_path)
+    assert transform(EXAMPLE, tmp_path, incremental=True, stream=stream) == full
+    assert written(tmp_path) == set()
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_new_subject(tmp_path: pathlib.Path, transform, stream: bool) -> None:
+    '''a new record with data in one form rewrites that instrument and SubjectData only'''
+    output = tmp_path.joinpath('output')
+    transform(EXAMPLE, output, incremental=True, stream=stream)
+    age(output)
+    file = new_subject(tmp_path)
+    assert transform(file, output, incremental=True, stream=stream) == transform(file)
+    assert written(output) == {'slide_tracking.csv', 'SubjectData.csv'}
+
+def test_removed_table(tmp_path: pathlib.Path, transform) -> None:
+    '''a deleted table is written again'''
+    full = transform(EXAMPLE, tmp_path, incremental=True)
+    tmp_path.joinpath('tma_information.csv').unlink()
+    age(tmp_path)
+    assert transform(EXAMPLE, tmp_path, incremental=True) == full
+    assert written(tmp_path) == {'tma_information.csv'}
+
+@pytest.mark.skipif(importlib.util.find_spec('pyarrow') is None, reason='pyarrow is not installed')
+def test_removed_columnar_copy(tmp_path: pathlib.Path, transform, monkeypatch: pytest.MonkeyPatch) -> None:
+    '''a deleted parquet copy is written again, with its csv'''
+    monkeypatch.setattr(src.export.export, 'columnar', 'parquet')
+    transform(EXAMPLE, tmp_path, incremental=True)
+    tmp_path.joinpath('slide_tracking.parquet').unlink()
+    age(tmp_path)
+    transform(EXAMPLE, tmp_path, incremental=True)
+    assert written(tmp_path) == {'slide_tracking.csv', 'slide_tracking.parquet'}
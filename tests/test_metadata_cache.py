@@ -0,0 +1,83 @@
+'''the metadata cache gives the same tables as a run without it, and is not used for a changed data dictionary or config'''
+import json
+import os
+import pathlib
+import shutil
+
+import pytest
+
+import src.cdisc
+import src.emx2
+
+INPUT = pathlib.Path('data/input')
+EXAMPLES = [
+    'Example_2_REDCap_repeated-measures.xml',
+    'Example_4_TestHumanCancer_data_REDCap.xml'
+]
+
+
+def renamed(tmp_path: pathlib.Path, example: str, old: str, new: str) -> pathlib.Path:
+    '''a copy of example with old replaced by new'''
+    file = tmp_path.joinpath(f'renamed_{example}')
+    file.write_text(INPUT.joinpath(example).read_text(encoding='utf-8').replace(old, new), encoding='utf-8')
+    return file
+
+def caches(folder: pathlib.Path) -> list:
+    return sorted(path.name for path in folder.iterdir())
+
+
+@pytest.mark.parametrize('stream', [False, True])
+@pytest.mark.parametrize('example', EXAMPLES)
+def test_round_trip(example: str, stream: bool, tmp_path: pathlib.Path, transform) -> None:
+    full = transform(example)
+    assert transform(example, stream=stream, metadata_cache=str(tmp_path)) == full
+    assert len(caches(tmp_path)) == 1
+    # the second run reads every result from the cache
+    assert transform(example, stream=stream, metadata_cache=str(tmp_path)) == full
+    cache = json.loads(tmp_path.joinpath(caches(tmp_path)[0]).read_text(encoding='utf-8'))
+    assert {'index', 'datamodel.instruments', 'datamodel.instruments.csv', 'checkbox_items', 'coded_variables'} <= cache.keys()
+
+def test_corrupt(tmp_path: pathlib.Path, transform) -> None:
+    example = EXAMPLES[0]
+    full = transform(example, metadata_cache=str(tmp_path))
+    tmp_path.joinpath(caches(tmp_path)[0]).write_text('{"index": {"MetaDataIndex": 1}, "coded')
+    assert transform(example, metadata_cache=str(tmp_path)) == full
+
+def test_changed_metadata(tmp_path: pathlib.Path, transform) -> None:
+    '''a changed data dictionary gets its own cache'''
+    example = 'Example_4_TestHumanCancer_data_REDCap.xml'
+    cache = tmp_path.joinpath('cache')
+    transform(example, metadata_cache=str(cache))
+    file = renamed(tmp_path, example, 'Slide Tracking', 'Slide tracking (renamed)')
+    assert transform(file, metadata_cache=str(cache)) == transform(file)
+    assert len(caches(cache)) == 2
+
+def test_changed_config(tmp_path: pathlib.Path, transform, monkeypatch: pytest.MonkeyPatch) -> None:
+    '''a changed config.ini setting ([redcap.datatype] rule) gets its own cache'''
+    example = 'Example_2_REDCap_repeated-measures.xml'
+    full = transform(example, metadata_cache=str(tmp_path))
+    monkeypatch.setitem(src.emx2.Emx2.config['redcap.datatype'], 'integer,slider,', 'decimal')
+    tables = transform(example, metadata_cache=str(tmp_path))
+    assert tables == transform(example)
+    assert tables['molgenis.csv'] != full['molgenis.csv']
+    assert len(caches(tmp_path)) == 2
+
+@pytest.mark.parametrize('metadata_cache', [False, True])
+@pytest.mark.parametrize('stream', [False, True])
+def test_refresh(stream: bool, metadata_cache: bool, tmp_path: pathlib.Path) -> None:
+    '''a file that changed after it was read is parsed again, the metadata comes from the new data dictionary'''
+    example = 'Example_4_TestHumanCancer_data_REDCap.xml'
+    file = tmp_path.joinpath(example)
+    shutil.copy(INPUT.joinpath(example), file)
+    xml = src.cdisc.Cdisc(str(file), stream=stream, metadata_cache=str(tmp_path.joinpath('cache')) if metadata_cache else '')
+    assert 'slide_tracking' in xml.form_names and xml.subject_keys == ('1', '2')
+    assert not xml.refresh()
+
+    changed = renamed(tmp_path, example, 'redcap:FormName="slide_tracking"', 'redcap:FormName="slides"')
+    changed.write_text(changed.read_text(encoding='utf-8').replace('SubjectKey="2"', 'SubjectKey="20"'), encoding='utf-8')
+    # a different size, the modification time can be the same on a coarse clock
+    os.replace(changed, file)
+    assert xml.refresh()
+    assert 'slides' in xml.form_names and 'slide_tracking' not in xml.form_names
+    assert 'slides' in xml.index.form_defs['Form.slide_tracking'].values()
+    assert xml.subject_keys == ('1', '20')
@@ -0,0 +1,66 @@
+'''the examples in data/input give the same metadata index, keys and tables with every parser backend, streamed or not'''
+import importlib.util
+import pathlib
+from typing import Dict
+
+import pytest
+
+import run
+import src.cdisc
+
+INPUT = pathlib.Path('data/input')
+
+EXAMPLES = [
+    'Example_1_REDCap_meta.xml',
+    'Example_2_REDCap_repeated-measures.xml',
+    'Example_3_TestHumanCancer_REDCap.xml',
+    'Example_4_TestHumanCancer_data_REDCap.xml'
+]
+
+PARSERS = [
+    'etree',
+    pytest.param('lxml', marks=pytest.mark.skipif(importlib.util.find_spec('lxml') is None, reason='lxml is not installed'))
+]
+
+
+def cdisc(example: str, parser: str, stream: bool) -> src.cdisc.Cdisc:
+    return src.cdisc.Cdisc(str(INPUT.joinpath(example)), 'REDCap', stream=stream, parser=parser, metadata_cache='')
+
+def tables(example: str, parser: str, stream: bool, output: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> Dict[str, bytes]:
+    '''file name -> content of everything Transform writes, the parser is selected in config.ini'''
+    with monkeypatch.context() as patch:
+        patch.setitem(src.cdisc.Cdisc.config['settings'], 'parser', parser)
+        run.Transform(edc='REDCap', file=example, stream=stream, output=str(output), metadata_cache='')
+    return {path.name: path.read_bytes() for path in sorted(output.iterdir())}
+
+@pytest.fixture(scope='module')
+def baseline(tmp_path_factory: pytest.TempPathFactory) -> Dict[str, Dict[str, bytes]]:
+    '''the tables of every example with the default parser (etree), not streamed'''
+    monkeypatch = pytest.MonkeyPatch()
+    try:
+        return {example: tables(example, 'etree', False, tmp_path_factory.mktemp('baseline'), monkeypatch) for example in EXAMPLES}
+    finally:
+        monkeypatch.undo()
+
+
+@pytest.mark.parametrize('stream', [False, True])
+@pytest.mark.parametrize('parser', PARSERS)
+@pytest.mark.parametrize('example', EXAMPLES)
+def test_index(example: str, parser: str, stream: bool) -> None:
+    assert vars(cdisc(example, parser, stream).index) == vars(cdisc(example, 'etree', False).index)
+
+@pytest.mark.parametrize('stream', [False, True])
+@pytest.mark.parametrize('parser', PARSERS)
+@pytest.mark.parametrize('example', EXAMPLES)
+def test_keys(example: str, parser: str, stream: bool) -> None:
+    keys = cdisc(example, parser, stream).clinical_data_keys()
+    assert keys == cdisc(example, 'etree', False).clinical_data_keys()
+    assert keys['subject_keys']
+
+@pytest.mark.parametrize('stream', [False, True])
+@pytest.mark.parametrize('parser', PARSERS)
+@pytest.mark.parametrize('example', EXAMPLES)
+def test_tables(example: str, parser: str, stream: bool, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch,
+        baseline: Dict[str, Dict[str, bytes]]) -> None:
+    assert 'molgenis.csv' in baseline[example] and 'SubjectData.csv' in baseline[example]
+    assert tables(example, parser, stream, tmp_path, monkeypatch) == baseline[example]
@@ -0,0 +1,59 @@
+'''files that are not a CDISC ODM export with ClinicalData, and an unknown forms selection, are rejected before the
+output folder is emptied'''
+import pathlib
+
+import pytest
+
+import src.cdisc
+import src.exceptions
+
+INPUT = pathlib.Path('data/input')
+
+
+@pytest.fixture
+def output(tmp_path: pathlib.Path) -> pathlib.Path:
+    '''an output folder with the tables of a previous run'''
+    output = tmp_path.joinpath('output')
+    output.mkdir()
+    output.joinpath('molgenis.csv').write_text('previous run')
+    return output
+
+@pytest.mark.parametrize('example, error', [
+    ('Example_5_missing-clinical-data.xml', src.exceptions.NoClinicalData),
+    ('Example_6_not-a-xml-file.docx', src.exceptions.InvalidXml)
+])
+def test_examples(example: str, error: type, output: pathlib.Path, transform) -> None:
+    with pytest.raises(error):
+        transform(example, output)
+    assert [path.name for path in output.iterdir()] == ['molgenis.csv']
+
+@pytest.mark.parametrize('content, error', [
+    (b'', src.exceptions.InvalidXml),
+    (b'not xml at all', src.exceptions.InvalidXml),
+    (b'<?xml version="1.0"?><ODM><Study/></ODM>', src.exceptions.NoNamespace),
+    (b'<?xml version="1.0"?><html xmlns="http://www.w3.org/1999/xhtml"/>', src.exceptions.InvalidXml),
+    (b'<?xml version="1.0"?><ODM xmlns="http://www.cdisc.org/ns/odm/v1.3"><Study/></ODM>', src.exceptions.NoClinicalData),
+    (b'PK\x03\x04 a zip file', src.exceptions.InvalidXml)
+])
+def test_preflight(content: bytes, error: type, tmp_path: pathlib.Path) -> None:
+    file = tmp_path.joinpath('export.xml')
+    file.write_bytes(content)
+    with pytest.raises(error):
+        src.cdisc.preflight(file)
+
+def test_truncated(tmp_path: pathlib.Path) -> None:
+    '''preflight stops at the ClinicalData start tag, a file that ends after it fails when it is parsed'''
+    file = tmp_path.joinpath('export.xml')
+    file.write_bytes(b'<?xml version="1.0"?><ODM xmlns="http://www.cdisc.org/ns/odm/v1.3"><ClinicalData StudyOID="S"><Subj')
+    assert src.cdisc.preflight(file) == 'http://www.cdisc.org/ns/odm/v1.3'
+    with pytest.raises(src.exceptions.InvalidXml):
+        src.cdisc.Cdisc(str(file))
+
+def test_preflight_namespace() -> None:
+    assert src.cdisc.preflight(INPUT.joinpath('Example_4_TestHumanCancer_data_REDCap.xml')) == 'http://www.cdisc.org/ns/odm/v1.3'
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_unknown_form(stream: bool, output: pathlib.Path, transform) -> None:
+    with pytest.raises(src.exceptions.NoForm):
+        transform('Example_4_TestHumanCancer_data_REDCap.xml', output, stream=stream, forms=['slide_tracking', 'bogus'])
+    assert [path.name for path in output.iterdir()] == ['molgenis.csv']
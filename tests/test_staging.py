@@ -0,0 +1,25 @@
+'''staging (the ClinicalData in a temporary SQLite database, one instrument at a time) gives the same tables as a full run'''
+import pathlib
+
+import pytest
+
+EXAMPLES = [
+    'Example_2_REDCap_repeated-measures.xml',
+    'Example_3_TestHumanCancer_REDCap.xml',
+    'Example_4_TestHumanCancer_data_REDCap.xml'
+]
+
+
+@pytest.mark.parametrize('stream', [False, True])
+@pytest.mark.parametrize('example', EXAMPLES)
+def test_staging(example: str, stream: bool, tmp_path: pathlib.Path, transform) -> None:
+    staging = tmp_path.joinpath('staging')
+    staging.mkdir()
+    assert transform(example, stream=stream, staging=str(staging)) == transform(example)
+    # the database is removed when the transform ends
+    assert list(staging.iterdir()) == []
+
+def test_staging_forms(transform) -> None:
+    forms = ['slide_tracking', 'Form.id_shipping']
+    example = 'Example_4_TestHumanCancer_data_REDCap.xml'
+    assert transform(example, stream=True, staging=True, forms=forms, subjects=['2']) == transform(example, forms=forms, subjects=['2'])